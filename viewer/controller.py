@@ -7,7 +7,8 @@ import numpy as np
 import pandas as pd
 from zipfile import ZipFile
 from PyQt6.QtGui import QShortcut, QKeySequence, QFont
-from PyQt6.QtWidgets import QInputDialog, QLineEdit, QMessageBox, QFileDialog, QProgressBar, QApplication
+from PyQt6.QtWidgets import QInputDialog, QLineEdit, QMessageBox, QFileDialog, QApplication, \
+    QProgressDialog
 from PyQt6.QtCore import pyqtSignal, QObject, Qt, QTimer, QThread
 
 from viewer.datahandler import DataHandler
@@ -17,6 +18,10 @@ from viewer.video_viewer import VideoViewer
 from viewer.video_converter import VideoConverter
 from viewer.multi_trace_plot import MultiPlotScrollArea
 from viewer.gui import ImportDataTracesWindow
+from viewer.plot_layers import create_trace_plot_layers, DecimatedCurveItem
+from viewer.session_h5 import h5_available, h5_file_formats, save_session_h5, load_session_h5, is_read_only
+from viewer.importers import CsvTraceImporter, MultiCsvTraceImporter, read_csv_header, read_sidecar_header, \
+    open_binary_traces, open_suite2p_folder, open_caiman_file, get_plane_names
 # from IPython import embed
 
 
@@ -64,61 +69,6 @@ class MyLinearRegionItem(pg.LinearRegionItem):
             self.setMouseHover(False)
 
 
-class HoverableCurveItem(pg.PlotCurveItem):
-    # SIGNALS
-    sigCurveHovered = pyqtSignal(int, object)
-    sigCurveNotHovered = pyqtSignal(int, object)
-    sigCurveClicked = pyqtSignal(object, object)
-    sigDeleteEvent = pyqtSignal(int)
-
-    def __init__(self, data_name, event_id, hoverPen, hoverable=True, *args, **kwargs):
-        super(HoverableCurveItem, self).__init__(*args, **kwargs)
-        self.data_name = data_name
-        self.event_id = event_id
-        self.hoverable = hoverable
-        self.setAcceptHoverEvents(True)
-        self.pen = self.opts['pen']
-        self.hoverPen = hoverPen
-
-    def hoverEvent(self, ev):
-        if self.hoverable:
-            try:
-                pos = ev.pos()
-                if self.mouseShape().contains(pos):
-                    # self.sigCurveHovered.emit(self, ev, self.data_name)
-                    self.sigCurveHovered.emit(self.event_id, ev)
-                    self.setPen(self.hoverPen)
-                    # self.setShadowPen(self.hoverShadowPen)
-                else:
-                    self.sigCurveNotHovered.emit(self.event_id, ev)
-                    self.setPen(self.pen)
-                    # self.setShadowPen(None)
-            except AttributeError:
-                self.setPen(self.pen)
-
-    @staticmethod
-    def delete_dialog():
-        msg_box = QMessageBox()
-        msg_box.setText('Delete Event ...')
-        msg_box.setInformativeText('Do you want to delete this event?')
-        msg_box.setStandardButtons(
-            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.Cancel)
-        msg_box.setDefaultButton(QMessageBox.StandardButton.Save)
-        retval = msg_box.exec()
-        return retval
-
-    def mouseClickEvent(self, ev):
-        if self.mouseShape().contains(ev.pos()):
-            self.sigCurveClicked.emit(self, ev)
-            if ev.button() == Qt.MouseButton.LeftButton:
-                retval = self.delete_dialog()
-                if retval == QMessageBox.StandardButton.Yes:
-                    self.sigDeleteEvent.emit(self.event_id)
-                    self.pen = None
-                    self.hoverPen = None
-                    self.setPen(self.pen)
-
-
 class Controller(QObject):
     # ==================================================================================================================
     # SIGNALS
@@ -146,15 +96,23 @@ class Controller(QObject):
         self.video_connected = False
         self.video_time_line = None
         self.video_time_line_stimulus = None
+        self.video_point = None
+        self.video_point_stimulus = None
 
         # Create Video Converter
         self.video_converter = VideoConverter(self.settings_file)
 
+        # The filter is computed when the slider did not move for filter_debounce_ms
+        self.filter_timer = QTimer()
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(int(self.settings_file.get('filter_debounce_ms')))
+        self.filter_timer.timeout.connect(self.start_filter_job)
+        self.filter_job = None
+
         self.plot_design()
         self.connections()
         self._create_short_cuts()
         self._connect_short_cuts(connect=True)
-        self.event_plots = []
         self.stimulus_onsets_visible = False
         self.stimulus_info_box_visible = False
         self.show_fbs = False
@@ -169,24 +127,44 @@ class Controller(QObject):
 
         self.filter_locked = True
         self.filter_is_active = False
+        self.data_handler = None
+        self.multi_plotter = None
         self._start_new_session()
         # self.data_handler.signal_new_data.emit()
 
         # Stimulus Reconstruction dt
         self.stimulus_dt = 0.001
-        self.multi_plotter = None
 
         self.get_sampling_rate_window = None
 
+        # Background csv import
+        self.import_thread = None
+        self.csv_importer = None
+        self.import_progress = None
+        self.import_running = False
+
     def _start_new_session(self):
         self.gui.info_label.setText('Please Open Data File ...')
         self.clear_plots()
-        self.event_plots = []
+        self.plot_layers = create_trace_plot_layers(self.gui.trace_plot_item)
+        self.plot_layers['events'].set_index(self.find_events)
+        event_curves = self.plot_layers['events'].curves
+        event_curves.sigCurveClicked.connect(self.event_clicked)
+        event_curves.sigCurveHovered.connect(self.show_event_info_box)
+        event_curves.sigCurveNotHovered.connect(self.hide_event_info_box)
+        # (stimulus onsets, y min, y max) the stimulus layers were set for
+        self.stimulus_layer_key = None
         self.show_fbs = False
         self.stimulus_onsets_visible = False
         self.stimulus_info_box_visible = False
         self.event_text = None
-        self.data_handler = DataHandler()
+        if self.multi_plotter is not None:
+            # Its rows read the traces of the session that is closed now
+            self.multi_plotter.close()
+            self.multi_plotter = None
+        if self.data_handler is not None:
+            self.data_handler.close_session_file()
+        self.data_handler = DataHandler(self.settings_file)
         self.signals()
         self.filter_locked = True
         self.filter_is_active = False
@@ -225,10 +203,13 @@ class Controller(QObject):
         self.gui.toolbar_show_stimulus_info.setDisabled(True)
         self.gui.file_menu_action_save_csv.setDisabled(False)
         self.gui.file_menu_action_save_flags.setDisabled(False)
+        self.gui.file_menu_action_save_filtered.setDisabled(False)
         self.gui.file_menu_action_save_viewer_file.setDisabled(False)
         self.gui.trace_plot_item.setLabel('left', 'Raw', **PlottingStyles.axis_label_styles)
         self.gui.toolbar_fbs_trace_action.setDisabled(False)
         self.gui.toolbar_save_figure.setDisabled(False)
+        # Min/max pyramids for zoomed out views (not needed if they were loaded with the session)
+        self.data_handler.start_pyramid_build()
 
     def plot_design(self):
         self.gui.trace_plot_item.setLabel('bottom', 'Time [s]', **PlottingStyles.axis_label_styles)
@@ -262,12 +243,19 @@ class Controller(QObject):
     def signals(self):
         # self.data_handler.signal_roi_id_changed.connect(lambda: self.plot_traces(update_axis=True))
         self.data_handler.signal_roi_id_changed.connect(lambda: self.update_plot(update_axis=True))
+        self.data_handler.signal_roi_id_changed.connect(self.prefetch_neighbours)
+        self.data_handler.signal_filter_ready.connect(self.filter_job_finished)
+        self.data_handler.signal_data_range_ready.connect(self.data_range_ready)
         self.data_handler.signal_roi_id_changed.connect(self.disconnect_video)
 
     def connections(self):
         # File Menu
         self.gui.file_menu_action_new_session.triggered.connect(self._start_new_session)
         self.gui.file_menu_action_import_traces.triggered.connect(self.import_traces_from_csv)
+        self.gui.file_menu_action_import_planes.triggered.connect(self.import_traces_from_csv_files)
+        self.gui.file_menu_action_import_binary_traces.triggered.connect(self.import_traces_from_binary)
+        self.gui.file_menu_action_import_suite2p.triggered.connect(self.import_suite2p)
+        self.gui.file_menu_action_import_caiman.triggered.connect(self.import_caiman)
         self.gui.file_menu_action_import_stimulus.triggered.connect(self.import_stimulus)
         # self.gui.file_menu_action_import_stimulus_trace.triggered.connect(self.import_single_trace)
         self.gui.file_menu_action_import_stimulus_trace.triggered.connect(self.import_extra_trace)
@@ -275,6 +263,7 @@ class Controller(QObject):
         self.gui.file_menu_action_import_meta_data.triggered.connect(self.import_meta_data)
         self.gui.file_menu_action_save_csv.triggered.connect(self.export_results)
         self.gui.file_menu_action_save_flags.triggered.connect(self.export_flags)
+        self.gui.file_menu_action_save_filtered.triggered.connect(self.export_filtered_traces)
         self.gui.file_menu_action_open_viewer_file.triggered.connect(self._load_file)
         self.gui.file_menu_action_save_viewer_file.triggered.connect(self._save_file)
         self.gui.file_menu_action_settings.triggered.connect(self._edit_settings)
@@ -288,6 +277,9 @@ class Controller(QObject):
 
         # MultiPlot
         self.gui.tools_menu_multiplot.triggered.connect(self.multi_plot)
+        self.gui.tools_menu_precompute.triggered.connect(self.precompute_normalizations)
+        self.gui.tools_menu_baseline_window.triggered.connect(self.set_baseline_window)
+        self.gui.tools_menu_memory_limit.triggered.connect(self.set_memory_limit)
 
         # Video Converter
         self.gui.tools_menu_video_converter.triggered.connect(self.open_video_converter)
@@ -313,6 +305,9 @@ class Controller(QObject):
         # Filter
         self.gui.filter_locK_button.clicked.connect(self.lock_filter_slider)
         self.gui.filter_slider.valueChanged.connect(self.filter_slider_changed)
+        # Replaces the preview after dragging
+        self.gui.filter_slider.sliderReleased.connect(self.filter_timer.start)
+        self.gui.toolbar_filter_type.currentIndexChanged.connect(self.filter_type_changed)
         self.gui.filter_slider.setDisabled(True)
         self.gui.filter_locK_button.setDisabled(True)
 
@@ -348,35 +343,13 @@ class Controller(QObject):
 
     def disconnect_video(self):
         self.video_connected = False
-        item_list = self.gui.trace_plot_item.items.copy()
-        for item in item_list:
-            if isinstance(item, pg.InfiniteLine):
-                self.gui.trace_plot_item.removeItem(item)
-
-        item_list = self.gui.stimulus_plot_item.items.copy()
-        for item in item_list:
-            if isinstance(item, pg.InfiniteLine):
-                self.gui.stimulus_plot_item.removeItem(item)
-
-        self.video_time_line = None
-        self.video_time_line_stimulus = None
+        self.plot_layers['video'].set_visible(False)
         self.video_viewer.connect_video_to_data_trace_button.setText('Connect to Data')
 
     def connect_video_to_data_trace(self, sig):
         self.video_connected = sig
         if not self.video_connected:
-            item_list = self.gui.trace_plot_item.items.copy()
-            for item in item_list:
-                if isinstance(item, pg.InfiniteLine):
-                    self.gui.trace_plot_item.removeItem(item)
-
-            item_list = self.gui.stimulus_plot_item.items.copy()
-            for item in item_list:
-                if isinstance(item, pg.InfiniteLine):
-                    self.gui.stimulus_plot_item.removeItem(item)
-
-            self.video_time_line = None
-            self.video_time_line_stimulus = None
+            self.plot_layers['video'].set_visible(False)
         self.check_video()
         self.plot_video_pos()
 
@@ -387,29 +360,54 @@ class Controller(QObject):
     # ==================================================================================================================
     # PLOTTING
     # ------------------------------------------------------------------------------------------------------------------
-    def progress_bar_update(self, val):
-        QApplication.processEvents()
-        self.progress.setValue(val)
-
     def multi_plot(self):
         if self.data_handler.data is not None:
-            # Prepare Data
-            data_set = self.data_handler.data.copy()
-            data_traces = []
-            for roi in data_set:
-                data_traces.append(data_set[roi]['data_traces'][self.data_handler.data_norm_mode])
-
-            # self.progress_win = QWidget()
-            self.progress = QProgressBar()
-            self.progress.setMaximum(len(data_traces))
-            self.progress.setGeometry(400, 400, 250, 20)
-            self.progress.show()
-
-            self.multi_plotter = MultiPlotScrollArea(np.array(data_traces))
-            self.multi_plotter.row_finished.connect(self.progress_bar_update)
+            # Only the visible rows are plotted, they read their traces from the trace store when they are shown
+            # (no copy of the data)
+            norm_mode = self.data_handler.data_norm_mode
+            roi_list = self.data_handler.meta_data['roi_list']
+            if self.multi_plotter is not None:
+                self.multi_plotter.close()
+            self.multi_plotter = MultiPlotScrollArea(
+                len(roi_list),
+                get_trace=lambda k: self.data_handler.get_roi_trace(roi_list[k], norm_mode),
+                get_label=lambda k: str(roi_list[k]),
+                get_pyramid=lambda k: self.data_handler.get_pyramid_reader(roi_list[k], norm_mode),
+                time_axis=self.data_handler.get_time_axis(roi_list[0]),
+            )
             self.multi_plotter.start()
             self.multi_plotter.show()
-            self.progress.close()
+
+    def precompute_normalizations(self):
+        if self.data_handler.data is not None:
+            QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+            self.data_handler.precompute_normalizations()
+            QApplication.restoreOverrideCursor()
+            self.data_handler.start_pyramid_build()
+            self.update_plot()
+
+    def set_baseline_window(self):
+        # Window of the running baseline (F0) in seconds, 0: one percentile of the whole trace
+        if self.data_handler.data is None:
+            return
+        fbs_window, ok = QInputDialog.getDouble(
+            self.gui, 'Baseline', f'Running baseline window (s), {self.data_handler.fbs_per:g}th percentile (0: off):',
+            self.data_handler.fbs_window, 0, 100000, 1)
+        if ok:
+            QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+            self.data_handler.set_fbs_percentile(self.data_handler.fbs_per, fbs_window=fbs_window)
+            QApplication.restoreOverrideCursor()
+            self.update_plot(update_axis=True)
+
+    def set_memory_limit(self):
+        # Out-of-core mode: max. memory (MB) for traces, the rest stays in files (0: everything in memory)
+        memory_limit, ok = QInputDialog.getInt(
+            self.gui, 'Memory Limit', 'Memory for traces in MB (0: off, keep all traces in memory):',
+            int(float(self.settings_file.get('memory_limit_mb'))), 0, 10 ** 7, 256)
+        if ok:
+            self.settings_file.modify_setting('memory_limit_mb', memory_limit)
+            self.settings_file.save_settings()
+            QMessageBox.information(self.gui, 'Memory Limit', 'The memory limit is used from the next import on')
 
     def update_linear_region(self):
         fr = self.data_handler.meta_data['sampling_rate']
@@ -471,247 +469,196 @@ class Controller(QObject):
         if self.data_handler.data[self.data_handler.roi_id]:
             print('')
 
-    def update_plot(self, update_axis=False, clear=True):
-        # Clear the plot
-        if clear:
-            self.gui.trace_plot_item.clear()
-
-        # Plot Data Trace
+    def update_plot(self, update_axis=False):
+        # All layers of the trace plot are updated in place (nothing is removed from the plot)
         self.gui.trace_plot_item.setTitle(f'ROI_{self.data_handler.roi_id}')
-        time_axis = self.data_handler.get_time_axis(self.data_handler.roi_id)
-        f_y = self.data_handler.data[self.data_handler.roi_id]['data_traces'][self.data_handler.data_norm_mode]
+        self._update_data_layer()
+        if update_axis:
+            self._update_axis_limits(time_axis=self.data_handler.get_time_axis(self.data_handler.roi_id))
+        self._update_filter_layer()
+        self._update_stimulus_layers()
+        self._update_event_layers()
+        self._update_baseline_layer()
+
+        # Plot ROI Single Traces (e.g. stimulus traces)
+        self.plot_single_traces()
 
+    def _update_data_layer(self):
+        time_axis = self.data_handler.get_time_axis(self.data_handler.roi_id)
+        f_y = self.data_handler.get_roi_trace(self.data_handler.roi_id)
+        layer = self.plot_layers['data']
         if self.filter_is_active:
-            trace_pen = PlottingStyles.line_pen_transparent
+            layer.set_pen(PlottingStyles.line_pen_transparent)
         else:
-            trace_pen = PlottingStyles.line_pen
-
-        plot_data_item = pg.PlotDataItem(
-            time_axis, f_y,
-            pen=trace_pen,
-            # name=f'{self.data_handler.data_name}_ROI{self.data_handler.roi_id}',
-            name=f'data_trace',
-            skipFiniteCheck=True,
-            tip=None,
-        )
-        self.gui.trace_plot_item.addItem(plot_data_item)
+            layer.set_pen(PlottingStyles.line_pen)
+        layer.set_data(time_axis, f_y, pyramid=self.data_handler.get_pyramid_reader(self.data_handler.roi_id))
 
-        if update_axis:
-            self._update_axis_limits(time_axis=time_axis)
-
-        # Plot Filtered Trace
+    def _update_filter_layer(self):
+        layer = self.plot_layers['filtered']
         if self.filter_is_active:
             self.data_handler.moving_average_filter()
             time_axis = self.data_handler.get_time_axis(self.data_handler.roi_id)
             f_y = self.data_handler.data[self.data_handler.roi_id]['data_traces']['filtered']
-            plot_data_item = pg.PlotDataItem(
-                time_axis, f_y,
-                pen=pg.mkPen(color='r'),
-                # name=f'{self.data_handler.data_name}_ROI{self.data_handler.roi_id}',
-                name=f'filtered_trace',
-                skipFiniteCheck=True,
-                tip=None,
-            )
-            self.gui.trace_plot_item.addItem(plot_data_item)
-
-        # Plot Stimulus
-        if self.stimulus_onsets_visible:
-            y_min, y_max = self.get_max_data_values()
-            k = 0
-            for start in self.data_handler.meta_data['stimulus']['start']:
-                plot_stimulus = pg.PlotDataItem(
-                    [start, start], [y_min, y_max],
-                    pen=pg.mkPen(color='b', width=1),
-                    skipFiniteCheck=True,
-                    name=f'stimulus_onset_{k}',
-                    tip=None,
-                )
+            layer.set_data(time_axis, f_y)
+        layer.set_visible(self.filter_is_active)
+
+    def _update_filter_layers(self):
+        # Everything that depends on the filter: data trace pen, filtered trace and the events (filtered cut outs)
+        self._update_data_layer()
+        self._update_filter_layer()
+        self._update_event_layers()
+
+    def _update_stimulus_layers(self):
+        # All onset lines are one item and all info boxes are one item: showing and hiding them only toggles the item.
+        # They span the y range of the current norm mode and are only set again when the stimulus or the range changes
+        onsets_layer = self.plot_layers['stimulus_onsets']
+        info_layer = self.plot_layers['stimulus_info']
+        onsets_layer.set_visible(self.stimulus_onsets_visible)
+        info_layer.set_visible(self.stimulus_info_box_visible)
+        if not (self.stimulus_onsets_visible or self.stimulus_info_box_visible):
+            return
+
+        stimulus = self.data_handler.meta_data['stimulus']
+        y_min, y_max = self.get_max_data_values()
+        key = self.stimulus_layer_key
+        if key is None or key[0] is not stimulus['start'] or key[1:] != (y_min, y_max):
+            onsets_layer.set_lines(stimulus['start'], y_min, y_max)
+            info_layer.set_labels(stimulus['start'], y_max, stimulus['info'])
+            self.stimulus_layer_key = (stimulus['start'], y_min, y_max)
+
+    def _update_event_layers(self):
+        # All events of the current ROI in a few batched items (see EventsLayer), the event traces are sample ranges of
+        # the trace of the ROI
+        if self.event_text is not None:
+            self.gui.trace_plot_item.removeItem(self.event_text)
+            self.event_text = None
+        roi_id = self.data_handler.roi_id
+        events = self.data_handler.get_roi_events(roi_id)
+        index = self.data_handler.get_event_index(roi_id)
+        time_axis = self.data_handler.get_time_axis(roi_id)
+        trace = self.data_handler.get_roi_trace(roi_id)
+        filtered_trace = self.data_handler.filtered_trace if self.filter_is_active else None
+        points_trace = trace if filtered_trace is None else filtered_trace
+        pens, hover_pens, filtered_pens = [], [], []
+        points, rise_fits, decay_fits = [], [], []
+        event_ids = index.event_ids.tolist()
+        for key in event_ids:
+            event = events[key]
+            pens.append(pg.mkPen(color=event['pen_color'], width=1))
+            hover_pens.append(pg.mkPen(color=event['hover_pen_color'], width=2))
+            filtered_pens.append(pg.mkPen(color=event['pen_darker_color']))
+
+            # The Points (first, center and last sample of the event)
+            points.append(([event['p1_t'], event['p2_t'], event['p3_t']],
+                           [points_trace[event['start_idx']], points_trace[event['center_idx']],
+                            points_trace[event['end_idx'] - 1]]))
+
+            # The Fits
+            rise_exp_t, rise_exp_y, decay_exp_t, decay_exp_y = self.get_exp_fits(event)
+            rise_fits.append((rise_exp_t, rise_exp_y))
+            decay_fits.append((decay_exp_t, decay_exp_y))
+
+        self.plot_layers['events'].set_events(
+            time_axis, trace, filtered_trace, event_ids, index.start_idx, index.end_idx, pens, hover_pens,
+            filtered_pens, points, rise_fits, decay_fits)
 
-                self.gui.trace_plot_item.addItem(plot_stimulus)
-                k += 1
-
-            # Plot Stimulus Info Box
-            if self.stimulus_info_box_visible:
-                self.show_stimulus_info_box()
-
-        # Plot Events
-        if self.data_handler.get_events_count(self.data_handler.roi_id) > 0:
-            self.event_plots = []
-            events = self.data_handler.get_roi_events(self.data_handler.roi_id)
-            for key in events:
-                t, f_y = self.cut_out_trace(start_idx=events[key]['start_idx'], end_idx=events[key]['end_idx'])
-                # plot_data_item = pg.PlotDataItem(
-                #     t, f_y,
-                #     pen=pg.mkPen(color=events[key]['pen_color']),
-                #     name=f'{key}_trace',
-                #     skipFiniteCheck=True,
-                #     tip=None,
-                # )
-                plot_data_item = HoverableCurveItem(
-                    x=t,
-                    y=f_y,
-                    name=f'event_{key}',
-                    pen=pg.mkPen(color=events[key]['pen_color'], width=1),
-                    hoverPen=pg.mkPen(color=events[key]['hover_pen_color'], width=2),
-                    data_name=f'event_{key}',
-                    event_id=key,
-                )
+    @staticmethod
+    def delete_event_dialog():
+        msg_box = QMessageBox()
+        msg_box.setText('Delete Event ...')
+        msg_box.setInformativeText('Do you want to delete this event?')
+        msg_box.setStandardButtons(
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.Cancel)
+        msg_box.setDefaultButton(QMessageBox.StandardButton.Save)
+        retval = msg_box.exec()
+        return retval
 
-                self.gui.trace_plot_item.addItem(plot_data_item)
-                self.event_plots.append(plot_data_item)
-                plot_data_item.sigDeleteEvent.connect(self.remove_event)
-                plot_data_item.sigCurveHovered.connect(self.show_event_info_box)
-                plot_data_item.sigCurveNotHovered.connect(self.hide_event_info_box)
-
-                if self.filter_is_active:
-                    # Filtered trace
-                    t2, f_y2 = self.cut_out_trace(start_idx=events[key]['start_idx'], end_idx=events[key]['end_idx'],
-                                                  filtered=True)
-                    # plot_data_item2 = HoverableCurveItem(
-                    #     x=t2,
-                    #     y=f_y2,
-                    #     name=f'event_{key}',
-                    #     pen=pg.mkPen(color=events[key]['pen_darker_color'], width=3),
-                    #     hoverPen=pg.mkPen(color=events[key]['hover_pen_color'], width=8),
-                    #     data_name=f'event_{key}',
-                    #     event_id=key,
-                    # )
-
-                    plot_data_item2 = pg.PlotDataItem(
-                        t2, f_y2,
-                        pen=pg.mkPen(color=events[key]['pen_darker_color']),
-                        name=f'{key}_trace',
-                        skipFiniteCheck=True,
-                        tip=None,
-                    )
-
-                    # plot_data_item2.setClickable(True)
-                    self.gui.trace_plot_item.addItem(plot_data_item2)
-                    self.event_plots.append(plot_data_item2)
-                    # plot_data_item2.sigDeleteEvent.connect(self.remove_event)
-                    # plot_data_item2.sigCurveHovered.connect(self.show_event_info_box)
-                    # plot_data_item2.sigCurveNotHovered.connect(self.hide_event_info_box)
-                self.plot_exp_fits()
-
-                # Plot the Points
-                p1_idx = 0
-                p2_idx = events[key]['center_idx']-events[key]['start_idx']
-                p3_idx = -1
-                p1_t = events[key]['p1_t']
-                p2_t = events[key]['p2_t']
-                p3_t = events[key]['p3_t']
-                points_t = [p1_t, p2_t, p3_t]
-                if self.filter_is_active:
-                    p1_y = f_y2[p1_idx]
-                    p2_y = f_y2[p2_idx]
-                    p3_y = f_y2[p3_idx]
-                else:
-                    p1_y = f_y[p1_idx]
-                    p2_y = f_y[p2_idx]
-                    p3_y = f_y[p3_idx]
-                points_y = [p1_y, p2_y, p3_y]
-
-                plot_data_item = pg.ScatterPlotItem(
-                    points_t, points_y,
-                    symbol='d',
-                    pen=pg.mkPen(color='b', width=2),
-                    brush=pg.mkBrush(color='g'),
-                    size=15,
-                    name=f'{key}_points',
-                    skipFiniteCheck=True,
-                    tip=None,
-                )
-                self.gui.trace_plot_item.addItem(plot_data_item)
+    def event_clicked(self, event_id, ev):
+        if ev.button() == Qt.MouseButton.LeftButton:
+            retval = self.delete_event_dialog()
+            if retval == QMessageBox.StandardButton.Yes:
+                self.remove_event(event_id)
 
+    def _update_baseline_layer(self):
+        layer = self.plot_layers['baseline']
         if self.show_fbs:
-            if self.data_handler.data_norm_mode == 'raw':
-                # fbs_trace = np.zeros_like(time_axis) + self.data_handler.data[self.data_handler.roi_id]['data_traces']['fbs']
-                fbs_trace = [self.data_handler.data[self.data_handler.roi_id]['data_traces']['fbs'], self.data_handler.data[self.data_handler.roi_id]['data_traces']['fbs']]
+            time_axis = self.data_handler.get_time_axis(self.data_handler.roi_id)
+            if self.data_handler.data_norm_mode == 'raw' and self.data_handler.get_fbs_window_samples() > 0:
+                # Running baseline (F0)
+                fbs_trace = self.data_handler.get_roi_trace(self.data_handler.roi_id, 'baseline')
+                time_points = time_axis
             else:
-                fbs_trace = [0, 0]
+                if self.data_handler.data_norm_mode == 'raw':
+                    fbs = self.data_handler.data[self.data_handler.roi_id]['data_traces']['fbs']
+                    fbs_trace = [fbs, fbs]
+                else:
+                    fbs_trace = [0, 0]
+                time_points = [np.min(time_axis), np.max(time_axis)]
+            layer.set_data(time_points, fbs_trace)
+        layer.set_visible(self.show_fbs)
 
-            time_points = [np.min(time_axis), np.max(time_axis)]
-            plot_data_item = pg.PlotDataItem(
-                time_points, fbs_trace,
-                pen=pg.mkPen(color='g', width=3),
-                name=f'base_line',
+    def plot_video_pos(self):
+        # Video cursor: a point on the data trace and a time line in the trace and stimulus plot
+        layer = self.plot_layers['video']
+        if not (self.video_viewer.isEnabled() and self.video_connected and self.data_handler.data is not None):
+            layer.set_visible(False)
+            return
+        self.check_video()
+        if not self.video_match:
+            layer.set_visible(False)
+            return
+
+        if not layer.items:
+            self.video_point = layer.add(pg.ScatterPlotItem(
+                symbol='o',
+                pen=pg.mkPen(color='r', width=2),
+                brush=pg.mkBrush(color='r'),
+                size=15,
+                name=f'video_point',
                 skipFiniteCheck=True,
                 tip=None,
-            )
-            self.gui.trace_plot_item.addItem(plot_data_item)
-
-        # Plot ROI Single Traces (e.g. stimulus traces)
-        self.plot_single_traces()
-
-    def plot_video_pos(self):
-        # check if there is already a plotted video point
-        item_list = self.gui.trace_plot_item.items.copy()
-        for item in item_list:
-            if item.name() == 'video_point':
-                self.gui.trace_plot_item.removeItem(item)
+            ))
+            self.video_time_line = layer.add(
+                pg.InfiniteLine(angle=90, movable=False, pen=PlottingStyles.time_line_pen), ignore_bounds=True)
+            self.video_time_line_stimulus = layer.add(
+                pg.InfiniteLine(angle=90, movable=False, pen=PlottingStyles.time_line_pen),
+                plot_item=self.gui.stimulus_plot_item, ignore_bounds=True)
+            self.video_point_stimulus = layer.add(pg.ScatterPlotItem(
+                symbol='o',
+                pen=pg.mkPen(color='r', width=2),
+                brush=pg.mkBrush(color='r'),
+                size=15,
+                name=f'video_point',
+                skipFiniteCheck=True,
+                tip=None,
+            ), plot_item=self.gui.stimulus_plot_item)
+        layer.set_visible(True)
 
-        if self.video_viewer.isEnabled() and self.video_connected and self.data_handler.data is not None:
-            self.check_video()
-            if self.video_match:
-                current_video_frame = self.video_viewer.current_frame
-                # time_axis = self.data_handler.get_time_axis(self.data_handler.roi_id)
-                if self.filter_is_active:
-                    y_data = self.data_handler.data[self.data_handler.roi_id]['data_traces']['filtered']
-                else:
-                    y_data = self.data_handler.data[self.data_handler.roi_id]['data_traces'][self.data_handler.data_norm_mode]
-                # Get current video frame
-                y_point = y_data[current_video_frame]
-                current_video_time = current_video_frame / self.data_handler.meta_data['sampling_rate']
-                print(f'video time: {current_video_time}')
-                # Plot the current Time Point on the data trace
-                scatter_item = pg.ScatterPlotItem(
-                    [current_video_time], [y_point],
-                    symbol='o',
-                    pen=pg.mkPen(color='r', width=2),
-                    brush=pg.mkBrush(color='r'),
-                    size=15,
-                    name=f'video_point',
-                    skipFiniteCheck=True,
-                    tip=None,
-                )
-                self.gui.trace_plot_item.addItem(scatter_item)
-                if self.video_time_line is None:
-                    # Plot a Time Line to the data trace and stimulus plot
-                    self.video_time_line = pg.InfiniteLine(angle=90, movable=False, pen=PlottingStyles.time_line_pen)
-                    self.video_time_line_stimulus = pg.InfiniteLine(angle=90, movable=False, pen=PlottingStyles.time_line_pen)
-                    self.gui.trace_plot_item.addItem(self.video_time_line, ignoreBounds=True)
-                    self.gui.stimulus_plot_item.addItem(self.video_time_line_stimulus, ignoreBounds=True)
-                    self.video_time_line.setPos(current_video_time)
-                    self.video_time_line_stimulus.setPos(current_video_time)
-                else:
-                    self.video_time_line.setPos(current_video_time)
-                    self.video_time_line_stimulus.setPos(current_video_time)
-
-                # check if there is already a plotted video point
-                item_list = self.gui.stimulus_plot_item.items.copy()
-                for item in item_list:
-                    if item.name() == 'video_point':
-                        self.gui.stimulus_plot_item.removeItem(item)
-                if 'stimulus_trace' in self.data_handler.data[self.data_handler.roi_id]:
-                    if len(self.data_handler.data[self.data_handler.roi_id]['stimulus_trace']) > 0:
-                        d = self.data_handler.data[self.data_handler.roi_id]['stimulus_trace']['Values']
-                        try:
-                            stimulus_dt = self.data_handler.meta_data['single_trace_dt']
-                        except IndexError:
-                            stimulus_dt = float(self.settings_file.settings_file.get('stimulus_sampling_dt'))
-                        current_sample = int(current_video_time / stimulus_dt)
-                        y_point = d[current_sample]
-                        scatter_item2 = pg.ScatterPlotItem(
-                            [current_video_time], [y_point],
-                            symbol='o',
-                            pen=pg.mkPen(color='r', width=2),
-                            brush=pg.mkBrush(color='r'),
-                            size=15,
-                            name=f'video_point',
-                            skipFiniteCheck=True,
-                            tip=None,
-                        )
-                        self.gui.stimulus_plot_item.addItem(scatter_item2)
+        current_video_frame = self.video_viewer.current_frame
+        if self.filter_is_active:
+            y_data = self.data_handler.data[self.data_handler.roi_id]['data_traces']['filtered']
+        else:
+            y_data = self.data_handler.get_roi_trace(self.data_handler.roi_id)
+        # Get current video frame
+        y_point = y_data[current_video_frame]
+        current_video_time = current_video_frame / self.data_handler.meta_data['sampling_rate']
+        print(f'video time: {current_video_time}')
+        # The current Time Point on the data trace
+        self.video_point.setData([current_video_time], [y_point])
+        self.video_time_line.setPos(current_video_time)
+        self.video_time_line_stimulus.setPos(current_video_time)
+
+        single_traces = self.data_handler.data[self.data_handler.roi_id].get('stimulus_trace', {})
+        if len(single_traces) > 0:
+            d = single_traces['Values']
+            try:
+                stimulus_dt = self.data_handler.meta_data['single_trace_dt']
+            except IndexError:
+                stimulus_dt = float(self.settings_file.settings_file.get('stimulus_sampling_dt'))
+            current_sample = int(current_video_time / stimulus_dt)
+            self.video_point_stimulus.setData([current_video_time], [d[current_sample]])
+        else:
+            self.video_point_stimulus.setVisible(False)
 
     def clear_plots(self):
         self.gui.trace_plot_item.clear()
@@ -729,13 +676,13 @@ class Controller(QObject):
         self.gui.trace_plot_item.setXRange(0, np.max(time_axis), padding=0)
         self.gui.trace_plot_item.setYRange(y_min, y_max, padding=0)
 
+    def find_events(self, t_min, t_max):
+        # Events of the current ROI in a time range (from the event index of the ROI)
+        return self.data_handler.find_events(self.data_handler.roi_id, t_min, t_max)
+
     def hide_event_info_box(self, event_id, ev):
-        event_name = f'{event_id}_info_box'
-        item_list = self.gui.trace_plot_item.items.copy()
-        for item in item_list:
-            # if not isinstance(item, pg.TextItem):
-            if item.name() == event_name:
-                self.gui.trace_plot_item.removeItem(item)
+        if self.event_text is not None:
+            self.gui.trace_plot_item.removeItem(self.event_text)
         self.event_text = None
 
     def show_event_info_box(self, event_id, ev):
@@ -761,112 +708,44 @@ class Controller(QObject):
                 self.gui.trace_plot_item.addItem(self.event_text)
                 self.event_text.setPos(pos[0], pos[1])
 
-    def plot_exp_fits(self):
-        # # check if there is already a plotted trace
-        # item_list = self.gui.trace_plot_item.items.copy()
-        # for item in item_list:
-        #     if item.name().startswith('Fit_'):
-        #         self.gui.trace_plot_item.removeItem(item)
-
-        events = self.data_handler.get_roi_events(roi_id=self.data_handler.roi_id)
-        for event, event_id in zip(events.values(), events):
-            # Cut out the event trace
-            cut_rise_time, cut_rise_y = self.cut_out_trace(
-                start_idx=event['start_idx'], end_idx=event['center_idx'], filtered=self.filter_is_active)
-            cut_decay_time, cut_decay_y = self.cut_out_trace(
-                start_idx=event['center_idx'], end_idx=event['end_idx'], filtered=self.filter_is_active)
-
-            # Get the first time point
-            t0_rise = np.min(cut_rise_time)
-            t0_decay = np.min(cut_decay_time)
-
-            # Normalize x and y values to fit data range
-            rise_exp_t = event['fit_rise_time'] + t0_rise
-            decay_exp_t = event['fit_decay_time'] + t0_decay
-            rise_exp_y = event['fit_rise_y'] * (np.max(cut_rise_y) - np.min(cut_rise_y)) + np.min(cut_rise_y)
-            decay_exp_y = event['fit_decay_y'] * (np.max(cut_decay_y) - np.min(cut_decay_y)) + np.min(cut_decay_y)
-
-            rise_plot = pg.PlotDataItem(
-                x=rise_exp_t, y=rise_exp_y,
-                pen=PlottingStyles.fit_rise_pen,
-                shadowPen=PlottingStyles.fit_rise_shadow_pen,
-                name=f'Fit_Rise_{event_id}',
-                tip=None,
-                skipFiniteCheck=True
-            )
-            decay_plot = pg.PlotDataItem(
-                x=decay_exp_t, y=decay_exp_y,
-                pen=PlottingStyles.fit_decay_pen,
-                shadowPen=PlottingStyles.fit_decay_shadow_pen,
-                name=f'Fit_Decay_{event_id}',
-                tip=None,
-                skipFiniteCheck=True
-            )
-            self.gui.trace_plot_item.addItem(rise_plot)
-            self.gui.trace_plot_item.addItem(decay_plot)
-            self.event_plots.append(rise_plot)
-            self.event_plots.append(decay_plot)
-
-    def hide_stimulus_info_box(self):
-        item_list = self.gui.trace_plot_item.items.copy()
-        for item in item_list:
-            if item.name().startswith('stimulus_info'):
-                self.gui.trace_plot_item.removeItem(item)
-
-    def show_stimulus_info_box(self):
-        y_min, y_max = self.get_max_data_values()
-        stimulus_info = self.data_handler.meta_data['stimulus']['info']
-        time_points = self.data_handler.meta_data['stimulus']['start']
-        for text, pos_x in zip(stimulus_info, time_points):
-            event_text = MyTextItem(
-                name=f'stimulus_info_{text}',
-                text=str(text),
-                color='k',
-                border=pg.mkPen(color='k'),
-                fill=pg.mkBrush(color='w'),
-            )
-            self.gui.trace_plot_item.addItem(event_text)
-            event_text.setPos(pos_x, y_max)
+    def get_exp_fits(self, event):
+        # Rise and decay fit of an event, scaled to the event trace
+        # Cut out the event trace
+        cut_rise_time, cut_rise_y = self.cut_out_trace(
+            start_idx=event['start_idx'], end_idx=event['center_idx'], filtered=self.filter_is_active)
+        cut_decay_time, cut_decay_y = self.cut_out_trace(
+            start_idx=event['center_idx'], end_idx=event['end_idx'], filtered=self.filter_is_active)
+
+        # Get the first time point
+        t0_rise = np.min(cut_rise_time)
+        t0_decay = np.min(cut_decay_time)
+
+        # Normalize x and y values to fit data range
+        rise_exp_t = event['fit_rise_time'] + t0_rise
+        decay_exp_t = event['fit_decay_time'] + t0_decay
+        rise_exp_y = event['fit_rise_y'] * (np.max(cut_rise_y) - np.min(cut_rise_y)) + np.min(cut_rise_y)
+        decay_exp_y = event['fit_decay_y'] * (np.max(cut_decay_y) - np.min(cut_decay_y)) + np.min(cut_decay_y)
+        return rise_exp_t, rise_exp_y, decay_exp_t, decay_exp_y
 
     def stimulus_info_box(self):
         if self.stimulus_info_box_visible:
-            self.hide_stimulus_info_box()
             self.gui.toolbar_show_stimulus_info.setText('Show Stimulus Info')
         else:
-            self.show_stimulus_info_box()
             self.gui.toolbar_show_stimulus_info.setText('Hide Stimulus Info')
 
         # Flip switch
         self.stimulus_info_box_visible = np.invert(self.stimulus_info_box_visible)
+        self._update_stimulus_layers()
 
     def plot_stimulus_onsets(self):
         if self.stimulus_onsets_visible:
             self.gui.toolbar_show_stimulus.setText('Show Stimulus')
-            # Remove Stimulus Onsets
-            item_list = self.gui.trace_plot_item.items.copy()
-            for item in item_list:
-                if item.name().startswith('stimulus_onset'):
-                    self.gui.trace_plot_item.removeItem(item)
         else:
-            # Plot Stimulus Onset
-            # stimulus_info = self.data_handler.meta_data['stimulus']['info']
             self.gui.toolbar_show_stimulus.setText('Hide Stimulus')
-            y_min, y_max = self.get_max_data_values()
-            k = 0
-            for start in self.data_handler.meta_data['stimulus']['start']:
-                plot_stimulus = pg.PlotDataItem(
-                    [start, start], [y_min, y_max],
-                    pen=pg.mkPen(color='b', width=1),
-                    skipFiniteCheck=True,
-                    name=f'stimulus_onset_{k}',
-                    tip=None,
-                )
-
-                self.gui.trace_plot_item.addItem(plot_stimulus)
-                k += 1
 
         # Flip the switch
         self.stimulus_onsets_visible = np.invert(self.stimulus_onsets_visible)
+        self._update_stimulus_layers()
 
     def plot_single_traces(self):
         # PLOT SINGLE TRACES
@@ -881,8 +760,8 @@ class Controller(QObject):
                 # d = self.data_handler.single_traces[self.data_handler.roi_id]
                 d = self.data_handler.data[self.data_handler.roi_id]['stimulus_trace']['Values']
                 t = self.data_handler.data[self.data_handler.roi_id]['stimulus_trace']['Time']
-                plot_data_item = pg.PlotDataItem(
-                    t, d,
+                plot_data_item = DecimatedCurveItem(
+                    x=t, y=d,
                     pen=PlottingStyles.single_trace_pen,
                     name=f'single_trace',
                     skipFiniteCheck=True,
@@ -904,8 +783,8 @@ class Controller(QObject):
                 self.gui.stimulus_plot_item.removeItem(item)
 
         if self.data_handler.meta_data['stimulus']['available']:
-            plot_data_item = pg.PlotDataItem(
-                self.data_handler.meta_data['stimulus']['time'], self.data_handler.meta_data['stimulus']['values'],
+            plot_data_item = DecimatedCurveItem(
+                x=self.data_handler.meta_data['stimulus']['time'], y=self.data_handler.meta_data['stimulus']['values'],
                 pen=PlottingStyles.stimulus_pen,
                 # name=f'{self.data_handler.data_name}_ROI{self.data_handler.roi_id}',
                 name=f'stimulus_trace',
@@ -952,6 +831,25 @@ class Controller(QObject):
             flagged_rois.columns = ['ROI']
             flagged_rois.to_csv(file_dir)
 
+    def export_filtered_traces(self):
+        # Filtered traces (current norm mode, filter and window) of all ROIs, same layout as the imported csv files
+        if self.data_handler.data is None or not self.data_handler.filter_window:
+            QMessageBox.critical(self.gui, 'ERROR', 'Please set a filter window first!')
+            return False
+        file_dir = self.select_save_file_dir(default_dir=self.settings_file.get('default_dir'),
+                                             file_format='csv file, (*.csv)')
+        if file_dir:
+            QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+            filtered = self.data_handler.filter_matrix()
+            roi_list = self.data_handler.meta_data['roi_list']
+            # Written in chunks of samples (the csv file is transposed)
+            chunk_size = 10000
+            with open(file_dir, 'w', newline='') as f:
+                for start in range(0, filtered.shape[1], chunk_size):
+                    chunk = pd.DataFrame(np.asarray(filtered[:, start:start + chunk_size]).T, columns=roi_list)
+                    chunk.to_csv(f, header=start == 0, index=False)
+            QApplication.restoreOverrideCursor()
+
     def flag_roi(self):
         roi = self.data_handler.roi_id
         flag = np.invert(self.data_handler.meta_data['roi_flags'][roi])
@@ -1192,17 +1090,18 @@ class Controller(QObject):
             # self.data_handler.sampling_rate = sampling_rate
             # Create a new data set
             roi_list = list(csv_file.keys())
-            self.data_handler.create_new_data_set(roi_list=roi_list, data_name=data_name, sampling_rate=sampling_rate)
+            self.data_handler.create_new_data_set(roi_list=roi_list, data_name=data_name, sampling_rate=sampling_rate,
+                                                  n_samples=csv_file.shape[0])
 
-            # Fill data set with traces in the csv file
-            for key in csv_file:
-                trace = csv_file[key]
-                self.data_handler.add_data_trace(trace.to_numpy(), 'raw', key)
+            # Fill data set with traces in the csv file (columns are ROIs, the store wants ROIs as rows)
+            self.data_handler.add_data_matrix(csv_file.to_numpy().T)
 
             self.data_handler.change_roi(roi_list[0])
             self.prepare_new_data()
 
     def import_traces_from_csv(self):
+        if self.import_running:
+            return
         # Set the desired file format
         file_format = 'csv file, (*.csv)'
         # Let the User choose a file
@@ -1223,24 +1122,233 @@ class Controller(QObject):
 
             self.settings_file.save_settings()
 
-            # Open the csv file using pandas
-            csv_file = pd.read_csv(file_dir, index_col=False)
+            # Only read the header here, the traces are parsed in the background
+            roi_list = read_csv_header(file_dir)
             data_name = os.path.split(file_dir)[1][:-4]
 
             # Start a new session
             self._start_new_session()
-            # self.data_handler.sampling_rate = sampling_rate
             # Create a new data set
-            roi_list = list(csv_file.keys())
             self.data_handler.create_new_data_set(roi_list=roi_list, data_name=data_name, sampling_rate=sampling_rate)
+            self.start_csv_import(file_dir)
 
-            # Fill data set with traces in the csv file
-            for key in csv_file:
-                trace = csv_file[key]
-                self.data_handler.add_data_trace(trace.to_numpy(), 'raw', key)
+    def import_traces_from_csv_files(self):
+        # Several csv files (e.g. one per imaging plane) into one session, ROI names get the plane name as prefix
+        if self.import_running:
+            return
+        file_format = 'csv file, (*.csv)'
+        file_dirs = QFileDialog.getOpenFileNames(
+            self.gui, 'Open Files (one per plane)', self.settings_file.get('default_dir').as_posix(), file_format)[0]
+        if file_dirs:
+            sampling_rate = self._ask_sampling_rate()
+            self.settings_file.modify_setting('sampling_rate', sampling_rate)
+            self.settings_file.modify_setting('sampling_dt', 1 / sampling_rate)
+            self.settings_file.save_settings()
 
-            self.data_handler.change_roi(roi_list[0])
-            self.prepare_new_data()
+            plane_names = get_plane_names(file_dirs)
+            roi_list = []
+            planes = dict()
+            for plane, file_dir in zip(plane_names, file_dirs):
+                planes[plane] = [f'{plane}_{roi}' for roi in read_csv_header(file_dir)]
+                roi_list.extend(planes[plane])
+            if len(set(roi_list)) < len(roi_list):
+                QMessageBox.critical(self.gui, 'ERROR', 'ROI names are not unique!')
+                return False
+            data_name = os.path.split(os.path.split(file_dirs[0])[0])[1]
+
+            self._start_new_session()
+            self.data_handler.create_new_data_set(roi_list=roi_list, data_name=data_name, sampling_rate=sampling_rate)
+            self.data_handler.meta_data['planes'] = planes
+            self.start_multi_csv_import(file_dirs, [len(planes[plane]) for plane in plane_names])
+
+    def import_traces_from_binary(self):
+        if self.import_running:
+            return
+        # Set the desired file format
+        file_format = 'binary data traces, (*.npy *.npz *.raw *.bin)'
+        # Let the User choose a file
+        file_dir = self.get_a_file_dir(default_dir=self.settings_file.get('default_dir'), file_format=file_format)
+        if file_dir:
+            # ROI names and sampling rate come from the sidecar header (if there is one)
+            header = read_sidecar_header(file_dir)
+            try:
+                traces = open_binary_traces(file_dir, header)
+            except (ValueError, OSError, KeyError) as e:
+                QMessageBox.critical(self.gui, 'ERROR', f'Could not open data traces: \n{e}')
+                return False
+
+            roi_list = header.get('roi_list', [f'ROI_{k}' for k in range(traces.shape[0])])
+            if len(roi_list) != traces.shape[0]:
+                QMessageBox.critical(self.gui, 'ERROR', 'Number of ROI names in the header does not match the data!')
+                return False
+
+            sampling_rate = header.get('sampling_rate')
+            if sampling_rate is None:
+                sampling_rate = self._ask_sampling_rate()
+            data_name = os.path.splitext(os.path.split(file_dir)[1])[0]
+            self._open_mapped_data_set(traces, roi_list, data_name, float(sampling_rate))
+
+    def import_suite2p(self):
+        if self.import_running:
+            return
+        folder = QFileDialog.getExistingDirectory(self.gui, 'Select Suite2p Folder (e.g. suite2p/plane0)',
+                                                  self.settings_file.get('default_dir').as_posix())
+        if folder:
+            try:
+                suite2p = open_suite2p_folder(folder)
+            except (ValueError, OSError) as e:
+                QMessageBox.critical(self.gui, 'ERROR', f'Could not open Suite2p results: \n{e}')
+                return False
+            traces = suite2p['F']
+            roi_list = [f'ROI_{k}' for k in range(traces.shape[0])]
+
+            sampling_rate = suite2p['ops'].get('fs')
+            if sampling_rate is None:
+                sampling_rate = self._ask_sampling_rate()
+
+            neuropil_coeff = 0
+            if suite2p['Fneu'] is not None:
+                neuropil_coeff, ok_pressed = QInputDialog.getDouble(
+                    self.gui, 'Neuropil', 'Neuropil coefficient (F - c * Fneu, 0: no subtraction):',
+                    float(suite2p['ops'].get('neucoeff', 0.7)), -10, 10, 2)
+                if not ok_pressed:
+                    neuropil_coeff = 0
+
+            # ROIs that Suite2p did not classify as cells start flagged
+            roi_flags = None
+            if suite2p['iscell'] is not None:
+                roi_flags = dict(zip(roi_list, (suite2p['iscell'][:, 0] > 0).tolist()))
+
+            data_name = os.path.split(os.path.normpath(folder))[1]
+            self._open_mapped_data_set(traces, roi_list, data_name, float(sampling_rate), neuropil=suite2p['Fneu'],
+                                       neuropil_coeff=neuropil_coeff, roi_flags=roi_flags)
+
+    def import_caiman(self):
+        if self.import_running:
+            return
+        if not h5_available():
+            QMessageBox.critical(self.gui, 'ERROR', 'CaImAn files need the h5py package (pip install h5py)')
+            return False
+        file_dir = self.get_a_file_dir(default_dir=self.settings_file.get('default_dir'),
+                                       file_format='CaImAn file, (*.hdf5 *.h5)')
+        if file_dir:
+            try:
+                caiman = open_caiman_file(file_dir)
+            except (ValueError, OSError, KeyError) as e:
+                QMessageBox.critical(self.gui, 'ERROR', f'Could not open CaImAn results: \n{e}')
+                return False
+            traces = caiman['C']
+            roi_list = [f'ROI_{k}' for k in range(traces.shape[0])]
+            sampling_rate = caiman['fr']
+            if sampling_rate is None:
+                sampling_rate = self._ask_sampling_rate()
+
+            roi_flags = None
+            if caiman['idx_components'] is not None:
+                accepted = np.zeros(len(roi_list), dtype=bool)
+                accepted[caiman['idx_components']] = True
+                roi_flags = dict(zip(roi_list, accepted.tolist()))
+
+            # Raw traces: C + YrA (denoised traces plus residuals), i.e. subtracting the residuals with coefficient -1
+            data_name = os.path.splitext(os.path.split(file_dir)[1])[0]
+            neuropil_coeff = -1 if caiman['YrA'] is not None else 0
+            self._open_mapped_data_set(traces, roi_list, data_name, float(sampling_rate), neuropil=caiman['YrA'],
+                                       neuropil_coeff=neuropil_coeff, roi_flags=roi_flags)
+            # Keep the file open while the traces are used, it is closed with the session
+            self.data_handler.source_file = caiman['file']
+
+    def _ask_sampling_rate(self):
+        # Get Sampling Rate from User: Let User choose to give rate or dt
+        sampling_rate_default = str(self.settings_file.get('sampling_rate'))
+        self.get_sampling_rate_window = ImportDataTracesWindow()
+        self.get_sampling_rate_window.set_default_val(default_val=sampling_rate_default)
+        self.get_sampling_rate_window.exec()
+        return self.get_sampling_rate_window.sampling_rate
+
+    def _open_mapped_data_set(self, traces, roi_list, data_name, sampling_rate, neuropil=None, neuropil_coeff=0,
+                              roi_flags=None):
+        # Start a new session
+        self._start_new_session()
+        self.data_handler.create_new_data_set(roi_list=roi_list, data_name=data_name, sampling_rate=sampling_rate,
+                                              n_samples=traces.shape[1])
+        # The traces stay memory mapped (or in their file), only the ROIs being viewed are read from disk
+        self.data_handler.add_mapped_data_matrix(traces)
+        if neuropil is not None:
+            self.data_handler.add_neuropil_matrix(neuropil, neuropil_coeff)
+        if roi_flags is not None:
+            self.data_handler.meta_data['roi_flags'] = roi_flags
+        self.data_handler.change_roi(roi_list[0])
+        self.prepare_new_data()
+        self.check_flag()
+
+    def start_csv_import(self, file_dir):
+        self._start_import(CsvTraceImporter(file_dir, self.data_handler.trace_store,
+                                            post_process=self._get_import_post_process()))
+
+    def start_multi_csv_import(self, file_dirs, plane_sizes):
+        max_workers = int(self.settings_file.get('import_processes'))
+        self._start_import(MultiCsvTraceImporter(file_dirs, plane_sizes, self.data_handler.trace_store,
+                                                 max_workers=max_workers, post_process=self._get_import_post_process()))
+
+    def _get_import_post_process(self):
+        # Precompute all normalized traces in the import thread if wanted
+        if self.data_handler.precompute_all:
+            return self.data_handler.precompute_normalizations
+        return None
+
+    def _start_import(self, importer):
+        self.import_running = True
+        self.import_progress = QProgressDialog('Importing Data Traces ...', 'Cancel', 0, 100, self.gui)
+        self.import_progress.setMinimumDuration(0)
+        self.import_progress.setValue(0)
+        self.import_progress.canceled.connect(self.cancel_csv_import)
+
+        # The importer fills the trace store in its own thread
+        self.import_thread = QThread()
+        self.csv_importer = importer
+        self.csv_importer.moveToThread(self.import_thread)
+        self.import_thread.started.connect(self.csv_importer.run)
+        self.csv_importer.progress.connect(self.import_progress.setValue)
+        self.csv_importer.first_roi_ready.connect(self.csv_import_first_roi_ready)
+        self.csv_importer.finished.connect(self.csv_import_finished)
+        self.csv_importer.cancelled.connect(self.csv_import_cancelled)
+        self.csv_importer.failed.connect(self.csv_import_failed)
+        self.import_thread.start()
+
+    def cancel_csv_import(self):
+        # Called from the GUI thread, the importer checks this flag between chunks
+        if self.csv_importer is not None:
+            self.csv_importer.cancel()
+
+    def csv_import_first_roi_ready(self):
+        # Show the first ROI while the others are still loading
+        roi = self.data_handler.meta_data['roi_list'][0]
+        self.data_handler.change_roi(roi)
+        self.gui.info_label.setText('Importing Data Traces ...')
+
+    def _finish_csv_import(self):
+        self.import_thread.quit()
+        self.import_thread.wait()
+        self.import_progress.close()
+        self.import_running = False
+        self.csv_importer = None
+        self.import_thread = None
+
+    def csv_import_finished(self):
+        self._finish_csv_import()
+        # ROIs that were shown while importing may have been cached (and the y range computed) before they were complete
+        self.data_handler.trace_store.invalidate()
+        self.data_handler.change_roi(self.data_handler.meta_data['roi_list'][0])
+        self.prepare_new_data()
+
+    def csv_import_cancelled(self):
+        self._finish_csv_import()
+        self._start_new_session()
+
+    def csv_import_failed(self, message):
+        self._finish_csv_import()
+        self._start_new_session()
+        QMessageBox.critical(self.gui, 'ERROR', f'Could not import data traces: \n{message}')
 
     def get_a_file_dir(self, default_dir, file_format):
         if default_dir.exists():
@@ -1259,9 +1367,16 @@ class Controller(QObject):
         return file_dir
 
     def _save_file(self):
-        file_dir = self.select_save_file_dir(default_dir=self.settings_file.get('default_dir'), file_format='viewer file, (*.vf)')
-        if file_dir:
-            data = pickle.dumps(self.data_handler.data)
+        file_dir = self.select_save_file_dir(default_dir=self.settings_file.get('default_dir'),
+                                             file_format='viewer file, (*.vf);; HDF5 session file, (*.h5 *.hdf5)')
+        if file_dir and file_dir.lower().endswith(h5_file_formats):
+            self._save_h5_file(file_dir)
+        elif file_dir and self.data_handler.is_out_of_core():
+            # Viewer files are pickled as a whole, HDF5 files are written ROI by ROI
+            QMessageBox.critical(self.gui, 'ERROR', 'In out-of-core mode sessions can only be saved as HDF5 files')
+            return False
+        elif file_dir:
+            data = pickle.dumps(self.data_handler.export_data())
             meta_data = pickle.dumps(self.data_handler.meta_data)
             filter_window = pickle.dumps(self.data_handler.filter_window)
 
@@ -1270,20 +1385,50 @@ class Controller(QObject):
                 zip_object.writestr('meta_data.pickle', meta_data)
                 zip_object.writestr('filter_window.pickle', filter_window)
 
+    def _save_h5_file(self, file_dir):
+        if not h5_available():
+            QMessageBox.critical(self.gui, 'ERROR', 'HDF5 session files need the h5py package (pip install h5py)')
+            return False
+        if is_read_only(file_dir, self.data_handler):
+            QMessageBox.critical(self.gui, 'ERROR', 'The session file is read-only, save the session to another file')
+            return False
+        compression = str(self.settings_file.get('h5_compression'))
+        if compression.lower() in ['none', 'nan', '']:
+            compression = None
+        try:
+            save_session_h5(file_dir, self.data_handler, compression=compression)
+        except (OSError, ValueError) as e:
+            QMessageBox.critical(self.gui, 'ERROR', f'Could not save session file: \n{e}')
+            return False
+
     def _load_file(self):
-        file_dir = self.get_a_file_dir(default_dir=self.settings_file.get('default_dir'), file_format='viewer file, (*.vf)')
+        file_dir = self.get_a_file_dir(default_dir=self.settings_file.get('default_dir'),
+                                       file_format='viewer file, (*.vf);; HDF5 session file, (*.h5 *.hdf5)')
         if file_dir:
             self._start_new_session()
-            with ZipFile(file_dir, 'r') as zip_object:
-                data = pickle.loads(zip_object.read('data.pickle'))
-                meta_data = pickle.loads(zip_object.read('meta_data.pickle'))
+            if file_dir.lower().endswith(h5_file_formats):
+                if not h5_available():
+                    QMessageBox.critical(
+                        self.gui, 'ERROR', 'HDF5 session files need the h5py package (pip install h5py)')
+                    return False
                 try:
-                    filter_window = pickle.loads(zip_object.read('filter_window.pickle'))
-                except KeyError:
-                    print('Foun No Filter Settings')
-                    filter_window = None
+                    # Traces stay in the file and are read per ROI
+                    filter_window = load_session_h5(file_dir, self.data_handler)
+                except (OSError, KeyError) as e:
+                    self._start_new_session()
+                    QMessageBox.critical(self.gui, 'ERROR', f'Could not open session file: \n{e}')
+                    return False
+            else:
+                with ZipFile(file_dir, 'r') as zip_object:
+                    data = pickle.loads(zip_object.read('data.pickle'))
+                    meta_data = pickle.loads(zip_object.read('meta_data.pickle'))
+                    try:
+                        filter_window = pickle.loads(zip_object.read('filter_window.pickle'))
+                    except KeyError:
+                        print('Foun No Filter Settings')
+                        filter_window = None
 
-            self.data_handler.load_new_data_set(data=data, meta_data=meta_data)
+                self.data_handler.load_new_data_set(data=data, meta_data=meta_data)
             self.data_handler.change_roi(self.data_handler.meta_data['roi_list'][0])
             self.prepare_new_data()
 
@@ -1328,7 +1473,7 @@ class Controller(QObject):
                                                           'Cannot connect video to data trace')
 
     def _next_roi(self):
-        if self.data_handler.data is not None:
+        if self.data_handler.data is not None and not self.import_running:
             roi_id_nr = self.data_handler.get_roi_index() + 1
             roi_id_nr = roi_id_nr % self.data_handler.get_roi_count()
             roi_id = self.data_handler.meta_data['roi_list'][roi_id_nr]
@@ -1338,7 +1483,7 @@ class Controller(QObject):
             self.check_flag()
 
     def _prev_roi(self):
-        if self.data_handler.data is not None:
+        if self.data_handler.data is not None and not self.import_running:
             roi_id_nr = self.data_handler.get_roi_index() - 1
             roi_id_nr = roi_id_nr % self.data_handler.get_roi_count()
             roi_id = self.data_handler.meta_data['roi_list'][roi_id_nr]
@@ -1353,6 +1498,7 @@ class Controller(QObject):
         self.data_handler.moving_average_filter()
         self.update_plot(update_axis=True)
         self.gui.trace_plot_item.setLabel('left', 'Norm. (min/max)', **PlottingStyles.axis_label_styles)
+        self.prefetch_neighbours()
 
     def _set_to_df(self):
         self.data_handler.data_norm_mode = 'df'
@@ -1361,6 +1507,7 @@ class Controller(QObject):
         self.data_handler.moving_average_filter()
         self.update_plot(update_axis=True)
         self.gui.trace_plot_item.setLabel('left', 'dF/F', **PlottingStyles.axis_label_styles)
+        self.prefetch_neighbours()
 
     def _set_to_z_score(self):
         self.data_handler.data_norm_mode = 'z'
@@ -1368,6 +1515,12 @@ class Controller(QObject):
         self.data_handler.moving_average_filter()
         self.gui.trace_plot_item.setLabel('left', 'Z-Score (SD)', **PlottingStyles.axis_label_styles)
         self.update_plot(update_axis=True)
+        self.prefetch_neighbours()
+
+    def prefetch_neighbours(self):
+        # Prepare the next and previous ROIs in the background (not while importing, rows may still be incomplete)
+        if not self.import_running:
+            self.data_handler.prefetch_neighbours(filtered=self.filter_is_active)
 
     def _set_to_raw(self):
         self.data_handler.data_norm_mode = 'raw'
@@ -1375,6 +1528,7 @@ class Controller(QObject):
         self.data_handler.moving_average_filter()
         self.gui.trace_plot_item.setLabel('left', 'Raw', **PlottingStyles.axis_label_styles)
         self.update_plot(update_axis=True)
+        self.prefetch_neighbours()
 
     def roi_selected(self):
         roi_id = self.gui.roi_selection_combobox.currentData()
@@ -1382,17 +1536,17 @@ class Controller(QObject):
 
     def get_max_data_values(self):
         # Get min and max values of all rois
-        max_vals = []
-        min_vals = []
-        for roi in self.data_handler.data:
-            data = self.data_handler.data[roi]['data_traces'][self.data_handler.data_norm_mode]
-            min_vals.append(np.min(data))
-            max_vals.append(np.max(data))
-
-        y_min, y_max = np.min(min_vals), np.max(max_vals)
-
+        y_min, y_max = self.data_handler.get_data_range()
         return y_min, y_max
 
+    def data_range_ready(self, norm_mode):
+        # The min/max of all ROIs was computed in the background (until then the range of the current ROI was used)
+        if self.data_handler.data is None or norm_mode != self.data_handler.data_norm_mode:
+            return
+        y_min, y_max = self.get_max_data_values()
+        self.gui.trace_plot_item.setYRange(y_min, y_max, padding=0)
+        self._update_stimulus_layers()
+
     @staticmethod
     def random_color():
         start = 50
@@ -1427,11 +1581,10 @@ class Controller(QObject):
         if self.show_fbs:
             self.show_fbs = False
             self.gui.toolbar_fbs_trace_action.setText('Show Baseline')
-            self.update_plot()
         else:
             self.show_fbs = True
             self.gui.toolbar_fbs_trace_action.setText('Hide Baseline')
-            self.update_plot()
+        self._update_baseline_layer()
 
     def set_collection_mode_color(self, on=True):
         if on:
@@ -1498,8 +1651,7 @@ class Controller(QObject):
             if self.filter_is_active:
                 trace = self.data_handler.filtered_trace
             else:
-                trace = self.data_handler.data[self.data_handler.roi_id]['data_traces'][
-                    self.data_handler.data_norm_mode]
+                trace = self.data_handler.get_roi_trace(self.data_handler.roi_id)
             self.point_collection.start_collecting(
                 trace_y=trace,
                 time_axis=self.data_handler.get_time_axis(self.data_handler.roi_id)
@@ -1518,8 +1670,7 @@ class Controller(QObject):
             if self.filter_is_active:
                 trace = self.data_handler.filtered_trace
             else:
-                trace = self.data_handler.data[self.data_handler.roi_id]['data_traces'][
-                    self.data_handler.data_norm_mode]
+                trace = self.data_handler.get_roi_trace(self.data_handler.roi_id)
 
             self.tau_collection.start_collecting(
                 trace_y=trace,
@@ -1561,7 +1712,7 @@ class Controller(QObject):
 
         # Exponential Fitting
         # # Cut out event
-        trace = self.data_handler.data[self.data_handler.roi_id]['data_traces'][self.data_handler.data_norm_mode]
+        trace = self.data_handler.get_roi_trace(self.data_handler.roi_id)
         fit_results = self.data_handler.fitter.fit_event(
             x=time_axis,
             y=trace,
@@ -1588,6 +1739,7 @@ class Controller(QObject):
             'pen_darker_color': rand_color_darker,
             'hover_pen_color': 'r',
             'filter_window': self.data_handler.filter_window,
+            'filter_type': self.data_handler.filter_type,
             'recording_name': self.data_handler.data_name,
             'sampling_rate': self.data_handler.meta_data['sampling_rate'],
             'norm_mode': self.data_handler.data_norm_mode,
@@ -1604,20 +1756,19 @@ class Controller(QObject):
     def cut_out_trace(self, start_idx, end_idx, filtered=False):
         time_axis = self.data_handler.get_time_axis(self.data_handler.roi_id)
         if filtered:
-            trace = self.data_handler.filtered_trace
+            cut_out = self.data_handler.filtered_trace[start_idx:end_idx]
         else:
-            trace = self.data_handler.data[self.data_handler.roi_id]['data_traces'][self.data_handler.data_norm_mode]
-        cut_out = trace[start_idx:end_idx]
+            # Only these samples are read (out-of-core mode)
+            cut_out = self.data_handler.get_roi_trace_slice(self.data_handler.roi_id, start_idx, end_idx)
         cut_out_time = time_axis[start_idx:end_idx]
         return cut_out_time, cut_out
 
     def cut_out_trace_for_plotting(self, start_idx, end_idx, roi, filtered=False):
         time_axis = self.data_handler.get_time_axis(roi)
         if filtered:
-            trace = self.data_handler.data[roi]['data_traces']['filtered']
+            cut_out = self.data_handler.data[roi]['data_traces']['filtered'][start_idx:end_idx]
         else:
-            trace = self.data_handler.data[roi]['data_traces'][self.data_handler.data_norm_mode]
-        cut_out = trace[start_idx:end_idx]
+            cut_out = self.data_handler.get_roi_trace_slice(roi, start_idx, end_idx)
         cut_out_time = time_axis[start_idx:end_idx]
         return cut_out_time, cut_out
 
@@ -1634,15 +1785,9 @@ class Controller(QObject):
 
     def remove_event(self, event_id):
         self.hide_event_info_box(event_id, ev=None)
-        event_names = [f'{event_id}_trace', f'event_{event_id}', f'Fit_Rise_{event_id}', f'Fit_Decay_{event_id}', f'{event_id}_points']
-        for event_name in event_names:
-            item_list = self.gui.trace_plot_item.items.copy()
-            for item in item_list:
-                # if not isinstance(item, pg.TextItem):
-                if item.name() == event_name:
-                    self.gui.trace_plot_item.removeItem(item)
-
         self.data_handler.remove_event(self.data_handler.roi_id, event_id)
+        # The remaining events are numbered again
+        self._update_event_layers()
 
     def collect_events_for_plotting(self):
         from IPython import embed
@@ -1807,15 +1952,39 @@ class Controller(QObject):
         slider_value = slider_value / 1000
         return slider_value
 
-    def filter_slider_changed(self):
+    def _set_filter_window(self):
         self.data_handler.filter_window = self.filter_slider_read()
         self.gui.filter_slider_label.setText(f'Filter Window: {self.data_handler.filter_window} s')
 
-        # Compute Filter
-        self.data_handler.moving_average_filter()
-
-        # Plot new trace
-        self.update_plot()
+    def filter_slider_changed(self):
+        self._set_filter_window()
+        if not self.filter_is_active or self.data_handler.data is None:
+            return
+        if self.gui.filter_slider.isSliderDown():
+            # Coarse preview while the slider is dragged
+            time_axis, values = self.data_handler.get_filter_preview(self.data_handler.filter_window)
+            self._set_filtered_curve(time_axis, values)
+        # Restarts the timer: only the last value is filtered
+        self.filter_timer.start()
+
+    def start_filter_job(self):
+        if self.filter_is_active and self.data_handler.data is not None:
+            self.filter_job = self.data_handler.start_filter_job(self.data_handler.filter_window)
+
+    def filter_job_finished(self, job_id):
+        # Results of superseded jobs (e.g. the slider moved again) are not shown
+        if job_id != self.filter_job or not self.filter_is_active or self.gui.filter_slider.isSliderDown():
+            return
+        # The filtered trace is in the cache now
+        self._update_filter_layers()
+
+    def _set_filtered_curve(self, time_axis, values):
+        self.plot_layers['filtered'].set_data(time_axis, values)
+
+    def filter_type_changed(self):
+        self.data_handler.set_filter_type(self.gui.toolbar_filter_type.currentData())
+        if self.filter_is_active:
+            self.filter_slider_changed()
 
     def activate_filter(self):
         if self.filter_is_active:
@@ -1824,9 +1993,7 @@ class Controller(QObject):
             self.filter_is_active = False
             self.lock_filter_slider()
             self.gui.filter_locK_button.setDisabled(True)
-            self.data_handler.change_roi(self.data_handler.roi_id)
-            # self.plot_filtered_trace()
-            self.update_plot()
+            self._update_filter_layers()
             self.gui.toolbar_filter_action.setText('Turn Filter ON')
         else:
             # Activate Filter
@@ -1834,11 +2001,10 @@ class Controller(QObject):
             self.filter_is_active = True
             self.lock_filter_slider()
             self.gui.filter_locK_button.setDisabled(False)
-            self.filter_slider_changed()
-            self.data_handler.change_roi(self.data_handler.roi_id)
-            # self.plot_filtered_trace()
-            self.update_plot()
+            self._set_filter_window()
+            self._update_filter_layers()
             self.gui.toolbar_filter_action.setText('Turn Filter OFF')
+            self.prefetch_neighbours()
 
     # ==================================================================================================================
     # MOUSE AND KEY PRESS HANDLING
@@ -1878,6 +2044,9 @@ class Controller(QObject):
         else:
             # Do not exit
             event.ignore()
+            return
+        # Removes the files of the out-of-core mode
+        self.data_handler.close_session_file()
 
     def exit_app(self):
         self.gui.close()
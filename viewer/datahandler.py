@@ -1,8 +1,15 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from scipy.optimize import curve_fit
 from PyQt6.QtCore import pyqtSignal, QObject
 from viewer.settings import SettingsFile
+from viewer.normalization import normalize_matrix, running_percentile, get_block_rows
+from viewer.filters import apply_filter, filter_bank, linear_filters
+from viewer.trace_store import TraceStore, RoiTraces
+from viewer.event_index import EventIndex
 from IPython import embed
 """
 Data Structure:
@@ -45,7 +52,7 @@ Data Structure:
 Data Structure:
 .
 ├── roi 1
-│   ├── data_traces
+│   ├── data_traces (RoiTraces: row views into the (ROI x time) matrices of the TraceStore)
 :   │       ├── raw   
     │       :
     │       └── df
@@ -80,16 +87,26 @@ Meta-Data Structure:
 
 class DataHandler(QObject):
     signal_roi_id_changed = pyqtSignal()
+    # Emitted from the filter thread (id of the filter job)
+    signal_filter_ready = pyqtSignal(int)
+    # Emitted from the background thread when the min/max of all traces of a mode is known (norm mode)
+    signal_data_range_ready = pyqtSignal(str)
 
-    def __init__(self):
+    def __init__(self, settings=None):
         QObject.__init__(self)
+        # The settings file of the controller (only one copy, saving writes the whole file)
+        self.settings = settings if settings is not None else SettingsFile()
         # Create a dictionary where each roi is a key with a default dictionary that will later contain all the data
-        self.settings = SettingsFile()
         self.data_traces_key = 'data_traces'
         self.extra_traces_key = 'extra_traces'
         self.events_key = 'events'
         self.stimulus_traces_key = 'stimulus_trace'
         self.data = None
+        self.trace_store = None
+        # Open HDF5 session file (traces are read from it on request)
+        self.session_file = None
+        # Other open files the traces are read from (e.g. CaImAn results)
+        self.source_file = None
         self.meta_data = dict()
         self.meta_data['meta_data'] = None
         self.meta_data['roi_flags'] = None
@@ -103,9 +120,44 @@ class DataHandler(QObject):
         self.roi_id = None
         self.time_axis = None
         self.fbs_per = float(self.settings.get('fbs_percentile'))
+        # Window of the running baseline in seconds (0: one percentile of the whole trace)
+        self.fbs_window = float(self.settings.get('fbs_window'))
+        # Storage precision of all traces (float64 or float32), computations are done in float64
+        self.dtype = np.dtype(self.settings.get('precision'))
+        # Normalized traces are computed per ROI when needed and cached, unless they are precomputed for all ROIs
+        self.trace_cache_size = int(self.settings.get('trace_cache_size'))
+        self.precompute_all = bool(int(self.settings.get('precompute_normalizations')))
+        # 0: one thread per CPU
+        self.normalization_threads = int(self.settings.get('normalization_threads')) or None
+        # Out-of-core mode (memory_limit_mb > 0): trace matrices are files in out_of_core_dir (or the temp directory)
+        # and at most memory_limit_mb of traces are kept in memory
+        self.memory_limit = int(float(self.settings.get('memory_limit_mb')) * 2 ** 20) or None
+        self.out_of_core_dir = str(self.settings.get('out_of_core_dir'))
+        # Number of ROIs before and after the current one that are prepared in a background thread
+        self.prefetch_rois = int(self.settings.get('prefetch_rois'))
+        self.prefetch_executor = None
+        # Increased for every new prefetch, older prefetch jobs stop
+        self.prefetch_generation = 0
+        # Min/max pyramids of the trace matrices and the min/max of all traces are computed in a background thread
+        self.pyramid_executor = None
+        self.pyramid_generation = 0
+        # (norm mode, trace store version) of the min/max job that is waiting or running
+        self.range_job = None
+        # (samples, sampling rate, time axis), the same for all ROIs
+        self.time_axis_cache = None
         # Filter Settings
         self.filter_window = None
+        # Filter jobs of the filter slider run in a background thread, only the newest job is computed
+        self.filter_executor = None
+        self.filter_job = 0
+        self.filter_type = str(self.settings.get('filter_type'))
+        if self.filter_type not in filter_bank:
+            self.filter_type = 'moving_average'
+        # (filter type, window, samples), filter applied to a trace of ones
+        self.filter_response = None
         self.filtered_trace = None
+        # ROI -> EventIndex
+        self.event_indices = dict()
         self.data_norm_mode = 'raw'
         self.fitter = ExpFitter()
         # self.single_traces = []
@@ -155,8 +207,8 @@ class DataHandler(QObject):
                         continue
                     trace = traces[key]
                     noise = trace[trace <= np.percentile(trace, p, axis=0)]
-                    noise_mean = np.mean(noise, axis=0)
-                    noise_sd = np.std(noise, axis=0)
+                    noise_mean = np.mean(noise, axis=0, dtype=np.float64)
+                    noise_sd = np.std(noise, axis=0, dtype=np.float64)
                     stats[f'{key}_mean'] = noise_mean
                     stats[f'{key}_sd'] = noise_sd
                 roi_stats[roi] = stats
@@ -174,47 +226,344 @@ class DataHandler(QObject):
     def moving_average_filter(self):
         if self.data is not None and self.filter_window is not None:
             win = int(self.filter_window * self.meta_data['sampling_rate'])
-            data = self.data[self.roi_id][self.data_traces_key][self.data_norm_mode]
             if win > 0:
-                filtered_data = np.convolve(data, np.ones(win) / win, mode='same')
-                self.data[self.roi_id][self.data_traces_key]['filtered'] = filtered_data
-                self.filtered_trace = filtered_data
+                filtered_data = self._get_filtered(self.roi_id, self.data_norm_mode, win)
             else:
-                self.data[self.roi_id][self.data_traces_key]['filtered'] = data
-                self.filtered_trace = data
+                filtered_data = self.data[self.roi_id][self.data_traces_key][self.data_norm_mode]
+            self.data[self.roi_id][self.data_traces_key]['filtered'] = filtered_data
+            self.filtered_trace = filtered_data
 
     def get_filtered_trace(self, roi_id, norm_mode):
         if self.data is not None and self.filter_window is not None:
             win = int(self.filter_window * self.meta_data['sampling_rate'])
-            trace = self.data[roi_id][self.data_traces_key][norm_mode]
             if win > 0:
-                filtered_data = np.convolve(trace, np.ones(win) / win, mode='same')
-                return filtered_data
+                return self._get_filtered(roi_id, norm_mode, win)
             else:
                 return None
 
+    def _get_filtered(self, roi_id, norm_mode, win):
+        # Cached per (ROI, norm mode, filter, window) until the trace changes, stored in the precision of the trace
+        # (at least the float precision of the trace store: memory mapped raw traces can be integers)
+        filter_type = self.filter_type
+
+        def filter_trace(trace):
+            coefficients = None
+            if norm_mode != 'raw' and filter_type in linear_filters:
+                coefficients = self._get_affine_coefficients(roi_id, norm_mode)
+            if coefficients is None:
+                filtered = apply_filter(filter_type, trace, win)
+            else:
+                # Only the raw trace is filtered: filter(a * raw + b) = a * filter(raw) + b * filter(1)
+                a, b = coefficients
+                filtered = a * self._get_filtered(roi_id, 'raw', win) + b * self._get_filter_response(len(trace), win)
+            return filtered.astype(np.result_type(trace.dtype, self.trace_store.dtype), copy=False)
+        return self.trace_store.filtered_row(norm_mode, roi_id, (filter_type, win), filter_trace)
+
+    def _get_filter_response(self, n_samples, win):
+        # The current filter applied to a trace of ones (differs from 1 only at the edges)
+        key = (self.filter_type, win, n_samples)
+        if self.filter_response is None or self.filter_response[0] != key:
+            self.filter_response = (key, apply_filter(self.filter_type, np.ones(n_samples), win))
+        return self.filter_response[1]
+
+    def _get_affine_coefficients(self, roi_id, norm_mode):
+        # a, b of norm trace = a * raw + b (None: not an affine transform of the raw trace, e.g. running baseline)
+        raw = np.asarray(self.trace_store.row('raw', roi_id), dtype=np.float64)
+        if norm_mode == 'min_max':
+            raw_min, raw_max = np.min(raw), np.max(raw)
+            return 1 / (raw_max - raw_min), -raw_min / (raw_max - raw_min)
+        if norm_mode not in ['df', 'z'] or self.get_fbs_window_samples() > 0:
+            return None
+        fbs = float(self.trace_store.get_fbs(roi_id))
+        if norm_mode == 'df':
+            return 1 / fbs, -1.0
+        # z score of df = raw / fbs - 1
+        df_mean = np.mean(raw) / fbs - 1
+        df_sd = np.std(raw) / abs(fbs)
+        return 1 / (fbs * df_sd), -(1 + df_mean) / df_sd
+
+    def start_filter_job(self, filter_window):
+        # Filter the current ROI in a background thread, signal_filter_ready(job id) is emitted when it is done.
+        # Jobs that are superseded by a newer one before they start are skipped.
+        if self.filter_executor is None:
+            self.filter_executor = ThreadPoolExecutor(max_workers=1)
+        self.filter_job += 1
+        self.filter_executor.submit(
+            self._run_filter_job, self.filter_job, self.roi_id, self.data_norm_mode, filter_window)
+        return self.filter_job
+
+    def _run_filter_job(self, job_id, roi_id, norm_mode, filter_window):
+        if job_id != self.filter_job:
+            return
+        win = int(filter_window * self.meta_data['sampling_rate'])
+        if win > 0:
+            # Result goes into the cache
+            self._get_filtered(roi_id, norm_mode, win)
+        if job_id == self.filter_job:
+            self.signal_filter_ready.emit(job_id)
+
+    def get_filter_preview(self, filter_window, max_samples=5000):
+        # Coarse filtered trace of the current ROI (time, values), filtered at a lower sampling rate
+        trace = self.get_roi_trace(self.roi_id)
+        step = max(1, len(trace) // max_samples)
+        time_axis = self.get_time_axis(self.roi_id)[::step]
+        decimated = np.asarray(trace[::step])
+        win = int(filter_window * self.meta_data['sampling_rate']) // step
+        if win <= 0:
+            return time_axis, decimated
+        return time_axis, apply_filter(self.filter_type, decimated, win)
+
+    def filter_matrix(self, norm_mode=None):
+        # Filtered traces of all ROIs (e.g. for exports), each block of ROIs is filtered in one call
+        if norm_mode is None:
+            norm_mode = self.data_norm_mode
+        win = int(self.filter_window * self.meta_data['sampling_rate']) if self.filter_window else 0
+        store = self.trace_store
+        filtered = store.new_matrix()
+        block_rows = get_block_rows(store.n_samples, store.get_roi_count())
+        for start in range(0, store.get_roi_count(), block_rows):
+            stop = min(start + block_rows, store.get_roi_count())
+            block = store.read_rows(norm_mode, start, stop)
+            filtered[start:stop] = apply_filter(self.filter_type, block, win) if win > 0 else block
+        store.flush()
+        return filtered
+
+    def set_filter_type(self, filter_type):
+        self.filter_type = filter_type
+        self.settings.modify_setting('filter_type', filter_type)
+        self.settings.save_settings()
+
     def add_roi_stimulus_trace(self, roi_id, trace_time, trace_values):
         if self.stimulus_traces_key not in self.data[roi_id]:
             self.data[roi_id][self.stimulus_traces_key] = dict()
         self.data[roi_id][self.stimulus_traces_key]['Time'] = trace_time
         self.data[roi_id][self.stimulus_traces_key]['Values'] = trace_values
 
-    def add_data_trace(self, data_trace, data_trace_name, roi_id):
-        # self.data[ROI_2]['data_traces']['raw']
-        self.data[roi_id][self.data_traces_key][data_trace_name] = data_trace
-
-        # Compute delta f over f
-        fbs, data_df = self._to_df_over_f(raw_data=data_trace)
-        self.data[roi_id][self.data_traces_key]['fbs'] = fbs
-        self.data[roi_id][self.data_traces_key]['df'] = data_df
-
-        # Compute z score
-        z_score = self._to_z_score(data_df)
-        self.data[roi_id][self.data_traces_key]['z'] = z_score
-
-        # Compute min max norm
-        min_max_norm = self._to_min_max(raw_data=data_trace)
-        self.data[roi_id][self.data_traces_key]['min_max'] = min_max_norm
+    def add_data_matrix(self, data_matrix):
+        # Add the raw traces of all ROIs at once (rows: ROIs, columns: samples)
+        self.trace_store.set_matrix('raw', data_matrix)
+        if self.precompute_all:
+            self.precompute_normalizations()
+
+    def precompute_normalizations(self):
+        # Compute df, z and min_max for all ROIs from the raw matrix and keep them (e.g. for batch exports).
+        # Runs blockwise over the (ROI x time) matrix in a thread pool, on-disk traces are read block by block.
+        store = self.trace_store
+
+        def read_raw(start, stop):
+            return store.read_rows('raw', start, stop)
+
+        out = None
+        if store.spill_dir is not None:
+            # Out-of-core: blocks are written straight to files
+            out = tuple(store.new_matrix() for _ in range(3))
+        fbs, data_df, z_score, min_max_norm = normalize_matrix(
+            read_raw, (store.get_roi_count(), store.n_samples), self.fbs_per,
+            fbs_window=self.get_fbs_window_samples(), dtype=store.dtype, n_threads=self.normalization_threads, out=out)
+        store.set_matrix('df', data_df)
+        store.set_matrix('z', z_score)
+        store.set_matrix('min_max', min_max_norm)
+        store.fbs[:] = fbs
+        store.flush()
+
+    def add_mapped_data_matrix(self, data_matrix, norm_mode='raw'):
+        # Traces that stay on disk (np.memmap, HDF5 dataset). Nothing is read here, modes without a matrix are
+        # derived from the raw traces per ROI when a ROI is requested, so only the ROIs being viewed are paged in.
+        self.trace_store.attach_matrix(norm_mode, data_matrix)
+
+    def set_fbs_percentile(self, fbs_percentile, fbs_window=None):
+        # fbs_window in seconds (None: keep the current window)
+        # Precomputed df and z are computed again for all ROIs only if the matrices are in memory or in the files of the
+        # out-of-core mode. Traces that are read from a file (e.g. a session file) would then have to fit into memory:
+        # the old df and z are dropped and derived per ROI when they are requested.
+        store = self.trace_store
+        precomputed = store.has_mode('df') and (not store.lazy or store.spill_dir is not None)
+        self.fbs_per = float(fbs_percentile)
+        if fbs_window is not None:
+            self.fbs_window = float(fbs_window)
+        self.trace_store.set_fbs_percentile(self.fbs_per, self.get_fbs_window_samples())
+        if precomputed:
+            self.precompute_normalizations()
+            self.start_pyramid_build()
+
+    def get_fbs_window_samples(self):
+        # Running baseline window in samples (0: no running baseline)
+        if self.fbs_window <= 0 or not self.meta_data['sampling_rate']:
+            return 0
+        return max(1, int(round(self.fbs_window * float(self.meta_data['sampling_rate']))))
+
+    def _create_trace_store(self, roi_list, n_samples=None):
+        spill_dir = None
+        if self.memory_limit is not None:
+            base_dir = self.out_of_core_dir if os.path.isdir(self.out_of_core_dir) else None
+            spill_dir = tempfile.mkdtemp(prefix='ca_viewer_', dir=base_dir)
+        trace_store = TraceStore(roi_list, n_samples=n_samples, dtype=self.dtype, cache_size=self.trace_cache_size,
+                                 memory_limit=self.memory_limit, spill_dir=spill_dir)
+        trace_store.derive = self._derive_roi_trace
+        trace_store.fbs_percentile = self.fbs_per
+        trace_store.fbs_window = self.get_fbs_window_samples()
+        return trace_store
+
+    def add_neuropil_matrix(self, neuropil_matrix, neuropil_coeff):
+        # Neuropil traces (ROI x time) that stay on disk, raw traces are F - neuropil_coeff * neuropil
+        self.trace_store.attach_matrix('neuropil', neuropil_matrix)
+        self.trace_store.set_neuropil_coeff(neuropil_coeff)
+
+    def set_neuropil_coeff(self, neuropil_coeff):
+        self.trace_store.set_neuropil_coeff(neuropil_coeff)
+
+    def is_out_of_core(self):
+        return self.trace_store is not None and self.trace_store.spill_dir is not None
+
+    def prefetch_neighbours(self, filtered=False):
+        # Derive (and filter) the traces of the next and previous ROIs in the current norm mode and build their min/max
+        # pyramids, so switching to them only reads the cache
+        if self.prefetch_rois <= 0 or self.data is None or self.roi_id is None:
+            return
+        if self.prefetch_executor is None:
+            self.prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        self.prefetch_generation += 1
+        roi_list = self.meta_data['roi_list']
+        roi_index = self.get_roi_index()
+        # Next ROI first, then the previous one, then the ones further away
+        rois = []
+        for k in range(1, self.prefetch_rois + 1):
+            for roi in [roi_list[(roi_index + k) % len(roi_list)], roi_list[(roi_index - k) % len(roi_list)]]:
+                if roi != self.roi_id and roi not in rois:
+                    rois.append(roi)
+        self.prefetch_executor.submit(self._prefetch, self.prefetch_generation, rois, self.data_norm_mode, filtered)
+
+    def _prefetch(self, generation, rois, norm_mode, filtered):
+        for roi in rois:
+            if generation != self.prefetch_generation:
+                # Another ROI was selected in the meantime
+                return
+            self.get_roi_trace(roi, norm_mode)
+            # Pyramid of the trace (built and cached for derived traces) and the y range read from it
+            self.trace_store.get_roi_range(norm_mode, roi)
+            if filtered:
+                self.get_filtered_trace(roi, norm_mode)
+
+    def start_pyramid_build(self):
+        # Build the min/max pyramids of all modes with a trace matrix (pyramids of derived traces are built per ROI)
+        if self.trace_store is None:
+            return
+        if self.pyramid_executor is None:
+            self.pyramid_executor = ThreadPoolExecutor(max_workers=1)
+        modes = [mode for mode in self.trace_store.norm_modes if self.trace_store.has_mode(mode)]
+        self.pyramid_executor.submit(self._build_pyramids, self.pyramid_generation, self.trace_store, modes)
+
+    def _build_pyramids(self, generation, store, modes):
+        def is_cancelled():
+            return generation != self.pyramid_generation
+
+        for mode in modes:
+            if is_cancelled():
+                return
+            if store.has_mode(mode) and not store.has_pyramid(mode):
+                store.build_pyramid_matrix(mode, is_cancelled=is_cancelled)
+
+    def start_range_build(self, norm_mode):
+        # Min and max of all traces of a mode in the background (reads all traces from disk or derives them block by
+        # block), signal_data_range_ready is emitted when it is done
+        key = (norm_mode, self.trace_store.version)
+        if self.range_job == key:
+            return
+        self.range_job = key
+        if self.pyramid_executor is None:
+            self.pyramid_executor = ThreadPoolExecutor(max_workers=1)
+        self.pyramid_executor.submit(self._build_range, self.pyramid_generation, self.trace_store, norm_mode)
+
+    def _build_range(self, generation, store, norm_mode):
+        def is_cancelled():
+            return generation != self.pyramid_generation
+
+        if not is_cancelled() and store.compute_range(norm_mode, is_cancelled=is_cancelled) is not None:
+            self.signal_data_range_ready.emit(norm_mode)
+
+    def get_pyramid_reader(self, roi_id, norm_mode=None):
+        # read_bins(start, stop) of the min/max pyramid of a trace (see decimation.py)
+        if norm_mode is None:
+            norm_mode = self.data_norm_mode
+        return self.trace_store.pyramid_reader(norm_mode, roi_id)
+
+    def stop_pyramid_build(self):
+        self.range_job = None
+        if self.pyramid_executor is not None:
+            self.pyramid_generation += 1
+            self.pyramid_executor.shutdown(wait=True, cancel_futures=True)
+            self.pyramid_executor = None
+
+    def stop_prefetch(self):
+        if self.prefetch_executor is not None:
+            self.prefetch_generation += 1
+            self.prefetch_executor.shutdown(wait=True, cancel_futures=True)
+            self.prefetch_executor = None
+
+    def close_session_file(self):
+        self.stop_prefetch()
+        self.stop_pyramid_build()
+        if self.filter_executor is not None:
+            self.filter_job += 1
+            self.filter_executor.shutdown(wait=True, cancel_futures=True)
+            self.filter_executor = None
+        if self.trace_store is not None:
+            # Removes the files of the out-of-core mode
+            self.trace_store.close()
+        if self.session_file is not None:
+            self.session_file.close()
+            self.session_file = None
+        if self.source_file is not None:
+            self.source_file.close()
+            self.source_file = None
+
+    def _derive_roi_trace(self, roi_id, norm_mode):
+        raw = np.asarray(self.trace_store.row('raw', roi_id), dtype=np.float64)
+        # Computed in float64, stored in the precision of the trace store
+        dtype = self.trace_store.dtype
+        if norm_mode == 'min_max':
+            return self._to_min_max(raw_data=raw).astype(dtype, copy=False)
+        base_line, data_df = self._to_df_over_f(raw_data=raw)
+        if norm_mode == 'baseline':
+            return np.broadcast_to(base_line, raw.shape).astype(dtype, copy=False)
+        fbs = np.mean(base_line)
+        self.trace_store.fbs[self.trace_store.get_row_index(roi_id)] = fbs
+        if norm_mode == 'fbs':
+            return fbs
+        if norm_mode == 'df':
+            return data_df.astype(dtype, copy=False)
+        if norm_mode == 'z':
+            return self._to_z_score(data_df).astype(dtype, copy=False)
+        raise KeyError(norm_mode)
+
+    def get_roi_trace(self, roi_id, norm_mode=None):
+        # Zero-copy row view of this ROI
+        if norm_mode is None:
+            norm_mode = self.data_norm_mode
+        return self.trace_store.row(norm_mode, roi_id)
+
+    def get_roi_trace_slice(self, roi_id, start, stop, norm_mode=None):
+        # Part of a trace (e.g. an event), on-disk traces only read these samples
+        if norm_mode is None:
+            norm_mode = self.data_norm_mode
+        return self.trace_store.row_slice(norm_mode, roi_id, start, stop)
+
+    def get_trace_matrix(self, norm_mode=None):
+        # The whole (ROI x time) matrix of this normalization mode
+        if norm_mode is None:
+            norm_mode = self.data_norm_mode
+        return self.trace_store.matrix(norm_mode)
+
+    def get_data_range(self, norm_mode=None):
+        # Min and max over all ROIs, cached per mode until the traces or the fbs settings change
+        if norm_mode is None:
+            norm_mode = self.data_norm_mode
+        if self.trace_store.range_is_cheap(norm_mode):
+            return self.trace_store.get_range(norm_mode)
+        # All traces have to be read from disk (or derived): this runs in the background, until it is done the range
+        # of the current ROI is used
+        self.start_range_build(norm_mode)
+        return self.trace_store.get_roi_range(norm_mode, self.roi_id)
 
     @staticmethod
     def _to_min_max(raw_data):
@@ -223,7 +572,12 @@ class DataHandler(QObject):
         return data_min_max
 
     def _to_df_over_f(self, raw_data):
-        fbs = np.percentile(raw_data, self.fbs_per, axis=0)
+        # fbs: one percentile of the whole trace or the running baseline (trace)
+        fbs_window = self.get_fbs_window_samples()
+        if fbs_window > 0:
+            fbs = running_percentile(raw_data, self.fbs_per, fbs_window)
+        else:
+            fbs = np.percentile(raw_data, self.fbs_per, axis=0)
         data_df = (raw_data - fbs) / fbs
         # mean correction
         # win = int(600 * self.meta_data['sampling_rate'])
@@ -233,12 +587,12 @@ class DataHandler(QObject):
 
     @staticmethod
     def _to_z_score(data):
-        z_score = (data - np.mean(data)) / np.std(data)
+        # Mean and SD are accumulated in float64 (also for float32 traces)
+        z_score = (data - np.mean(data, dtype=np.float64)) / np.std(data, dtype=np.float64)
         return z_score
 
     def get_roi_index(self):
-        roi_index = np.where(self.roi_id == np.array(self.meta_data['roi_list']))[0][0]
-        return roi_index
+        return self.trace_store.get_row_index(self.roi_id)
 
     def change_roi(self, new_roi):
         self.roi_id = new_roi
@@ -251,28 +605,33 @@ class DataHandler(QObject):
         return time_steps
 
     def get_time_axis(self, roi_id):
-        data_size = self.data[roi_id]['data_traces']['raw'].shape[0]
-        self.time_axis = self.convert_samples_to_time(data_size, self.meta_data['sampling_rate'])
+        # All ROIs have the same time axis, it is only computed again when samples or sampling rate change
+        key = (self.trace_store.n_samples, self.meta_data['sampling_rate'])
+        if self.time_axis_cache is None or self.time_axis_cache[0] != key:
+            self.time_axis_cache = (key, self.convert_samples_to_time(key[0], key[1]))
+        self.time_axis = self.time_axis_cache[1]
         return self.time_axis
 
     def create_flags(self):
         roi_list = self.meta_data['roi_list']
         self.meta_data['roi_flags'] = dict().fromkeys(roi_list, True)
 
-    def create_new_data_set(self, roi_list, data_name, sampling_rate):
+    def create_new_data_set(self, roi_list, data_name, sampling_rate, n_samples=None):
         # Create an empty data set
         self.meta_data['roi_list'] = roi_list
         self.meta_data['roi_flags'] = dict().fromkeys(roi_list, True)
+        self.meta_data['sampling_rate'] = sampling_rate
+        self.trace_store = self._create_trace_store(roi_list, n_samples=n_samples)
         self.data = dict().fromkeys(roi_list)
+        self.event_indices = dict()
         for key in self.data:
             self.data[key] = {
-                self.data_traces_key: {},
+                self.data_traces_key: RoiTraces(self.trace_store, key),
                 self.events_key: {},
                 self.stimulus_traces_key: {},
                 self.extra_traces_key: {}
             }
         self.data_name = data_name
-        self.meta_data['sampling_rate'] = sampling_rate
 
     def get_roi_count(self):
         if self.meta_data['roi_list'] is not None:
@@ -290,6 +649,7 @@ class DataHandler(QObject):
         else:
             event_id = cc
         self.data[roi_id][self.events_key][event_id] = event_data
+        self.event_indices.pop(roi_id, None)
 
     def get_event(self, roi_id, event_id):
         try:
@@ -301,9 +661,25 @@ class DataHandler(QObject):
     def get_roi_events(self, roi_id):
         return self.data[roi_id][self.events_key]
 
+    def get_event_index(self, roi_id):
+        # Time sorted index of the events of a ROI, built again after events were added or removed
+        index = self.event_indices.get(roi_id)
+        if index is None:
+            index = EventIndex(self.get_roi_events(roi_id))
+            self.event_indices[roi_id] = index
+        return index
+
+    def find_events(self, roi_id, t_min, t_max):
+        # Ids of the events of a ROI whose curve is in the time range t_min ... t_max (s): the samples in the range plus
+        # the sample on each side (the line to them crosses the range)
+        time_axis = self.get_time_axis(roi_id)
+        start = max(int(np.searchsorted(time_axis, t_min, side='left')) - 1, 0)
+        stop = int(np.searchsorted(time_axis, t_max, side='right')) + 1
+        return self.get_event_index(roi_id).overlapping(start, stop)
+
     def get_roi_data_trace_size(self, roi_id):
         if self.data is not None:
-            return self.data[roi_id][self.data_traces_key][self.data_norm_mode].shape[0]
+            return self.trace_store.n_samples
         else:
             return None
 
@@ -328,9 +704,11 @@ class DataHandler(QObject):
         try:
             del self.data[roi_id][self.events_key][event_id]
             # Reset keys (renumerate)
-            self.data[roi_id][self.events_key] = {i: v for i, v in enumerate(self.data[roi_id][self.events_key].values())}
+            events = self.data[roi_id][self.events_key]
+            self.data[roi_id][self.events_key] = {i: v for i, v in enumerate(events.values())}
         except KeyError:
             pass
+        self.event_indices.pop(roi_id, None)
 
     def get_events_count(self, roi_id):
         return len(self.data[roi_id][self.events_key])
@@ -341,6 +719,14 @@ class DataHandler(QObject):
     def get_roi_data_traces(self, roi_id):
         return self.data[roi_id][self.data_traces_key]
 
+    def export_data(self):
+        # Plain dict version of the data set (same structure as before the trace store existed)
+        data = dict()
+        for roi in self.data:
+            data[roi] = dict(self.data[roi])
+            data[roi][self.data_traces_key] = self.data[roi][self.data_traces_key].to_dict()
+        return data
+
     def load_new_data_set(self, data, meta_data):
         if self.meta_data['roi_flags'] is None:
             self.data = data
@@ -349,6 +735,25 @@ class DataHandler(QObject):
         else:
             self.data = data
             self.meta_data = meta_data
+        self.event_indices = dict()
+        self._build_trace_store()
+
+    def _build_trace_store(self):
+        # Move the per ROI traces of a loaded data set into the (ROI x time) matrices of a new trace store
+        roi_list = self.meta_data['roi_list']
+        self.trace_store = self._create_trace_store(roi_list)
+        for mode in self.trace_store.norm_modes:
+            if all(mode in self.data[roi][self.data_traces_key] for roi in roi_list):
+                matrix = np.array([self.data[roi][self.data_traces_key][mode] for roi in roi_list])
+                self.trace_store.set_matrix(mode, matrix)
+
+        for roi in roi_list:
+            old_traces = self.data[roi][self.data_traces_key]
+            roi_traces = RoiTraces(self.trace_store, roi)
+            for key in old_traces:
+                if key not in self.trace_store.norm_modes:
+                    roi_traces[key] = old_traces[key]
+            self.data[roi][self.data_traces_key] = roi_traces
 
 
 class ExpFitter:
@@ -393,6 +798,9 @@ class ExpFitter:
         return tau_value, p_value
 
     def fit_event(self, x, y, idx):
+        # Fit in float64 (traces may be stored as float32)
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
         # First the Rise Phase
         rise_y = y[idx[0]:idx[1]]
         rise_x = x[idx[0]:idx[1]]
@@ -0,0 +1,124 @@
+import numpy as np
+
+# Min/max decimation of long traces for plotting. Only the visible x range is decimated, into one column per screen
+# pixel: each column keeps its smallest and its largest sample (in time order), so no peak is lost, however narrow.
+# With not more than 2 samples per pixel column the samples are plotted as they are.
+
+
+def get_visible_slice(x, x_min, x_max):
+    # Index range of the samples in [x_min, x_max] (x sorted), plus one sample on each side so that the line runs to
+    # the edges of the view
+    start = max(int(np.searchsorted(x, x_min, side='left')) - 1, 0)
+    stop = min(int(np.searchsorted(x, x_max, side='right')) + 1, len(x))
+    return start, stop
+
+
+def min_max_indices(y, start, stop, n_columns):
+    # Indices of the min and max sample of each column of y[start:stop], sorted
+    n_samples = stop - start
+    step = int(np.ceil(n_samples / max(int(n_columns), 1)))
+    n_full = n_samples // step
+    block = np.asarray(y[start:start + n_full * step]).reshape(n_full, step)
+    offsets = start + np.arange(n_full) * step
+    idx_min = np.argmin(block, axis=1) + offsets
+    idx_max = np.argmax(block, axis=1) + offsets
+    idx = np.stack([np.minimum(idx_min, idx_max), np.maximum(idx_min, idx_max)], axis=1).ravel()
+
+    # The last column can be shorter
+    rest = start + n_full * step
+    if rest < stop:
+        tail = np.asarray(y[rest:stop])
+        tail_idx = sorted({rest + int(np.argmin(tail)), rest + int(np.argmax(tail))})
+        idx = np.concatenate([idx, tail_idx])
+    return idx
+
+
+def min_max_envelope(x, y, x_min, x_max, n_columns):
+    # Samples of the visible x range (x_min ... x_max) decimated to n_columns pixel columns
+    start, stop = get_visible_slice(x, x_min, x_max)
+    if stop - start <= 2 * n_columns:
+        return x[start:stop], y[start:stop]
+    idx = min_max_indices(y, start, stop, n_columns)
+    return x[idx], y[idx]
+
+
+# Level of detail pyramid of a trace: level k (k = 1, 2, ...) holds the min and max of bins of 2 ** k samples, so each
+# level halves the resolution of the level below. All levels of a trace are one (bins x 2) array (min, max), level
+# after level. Zoomed out views read the level that fits the number of pixel columns instead of all samples.
+# The coarsest level has not more than pyramid_min_bins bins
+pyramid_min_bins = 256
+
+
+def get_pyramid_levels(n_samples):
+    # (bin size, offset, number of bins) of each level
+    levels = []
+    offset = 0
+    bin_size = 2
+    while True:
+        n_bins = -(-n_samples // bin_size)
+        levels.append((bin_size, offset, n_bins))
+        offset += n_bins
+        if n_bins <= pyramid_min_bins:
+            return levels
+        bin_size *= 2
+
+
+def get_pyramid_size(n_samples):
+    _, offset, n_bins = get_pyramid_levels(n_samples)[-1]
+    return offset + n_bins
+
+
+def build_pyramid(traces, dtype=None):
+    # Pyramid of a trace (or of each row of a (ROI x time) matrix): shape (..., bins, 2)
+    traces = np.asarray(traces)
+    levels = get_pyramid_levels(traces.shape[-1])
+    pyramid = np.empty(traces.shape[:-1] + (get_pyramid_size(traces.shape[-1]), 2),
+                       dtype=traces.dtype if dtype is None else dtype)
+    low = high = traces
+    for _, offset, n_bins in levels:
+        if low.shape[-1] % 2:
+            # The last bin is filled up with the last sample
+            low = np.concatenate([low, low[..., -1:]], axis=-1)
+            high = np.concatenate([high, high[..., -1:]], axis=-1)
+        pyramid[..., offset:offset + n_bins, 0] = np.minimum(low[..., 0::2], low[..., 1::2])
+        pyramid[..., offset:offset + n_bins, 1] = np.maximum(high[..., 0::2], high[..., 1::2])
+        low = pyramid[..., offset:offset + n_bins, 0]
+        high = pyramid[..., offset:offset + n_bins, 1]
+    return pyramid
+
+
+def get_pyramid_bounds(n_samples, read_bins):
+    # Min and max of the whole trace from the coarsest level
+    _, offset, n_bins = get_pyramid_levels(n_samples)[-1]
+    bins = np.asarray(read_bins(offset, offset + n_bins))
+    return np.nanmin(bins[:, 0]), np.nanmax(bins[:, 1])
+
+
+def pyramid_envelope(x, x_min, x_max, n_columns, read_samples, read_bins):
+    # Same as min_max_envelope, but reads the pyramid level with the largest bins that still has 2 bins per pixel
+    # column (at most about 4 bins per column are read). Close zooms read the samples (read_samples(start, stop)),
+    # read_bins(start, stop) returns bins of the pyramid.
+    n_columns = max(int(n_columns), 1)
+    start, stop = get_visible_slice(x, x_min, x_max)
+    samples_per_column = (stop - start) / n_columns
+    level = None
+    for bin_size, offset, n_bins in get_pyramid_levels(len(x)):
+        if 2 * bin_size <= samples_per_column:
+            level = (bin_size, offset, n_bins)
+
+    if level is None:
+        y = np.asarray(read_samples(start, stop))
+        if stop - start <= 2 * n_columns:
+            return x[start:stop], y
+        idx = min_max_indices(y, 0, stop - start, n_columns)
+        return x[start + idx], y[idx]
+
+    bin_size, offset, n_bins = level
+    first = start // bin_size
+    last = min(-(-stop // bin_size), n_bins)
+    # min, max, min, max, ...
+    values = np.asarray(read_bins(offset + first, offset + last)).ravel()
+    idx = min_max_indices(values, 0, len(values), n_columns)
+    # A bin is plotted at its center sample
+    samples = np.minimum((first + idx // 2) * bin_size + bin_size // 2, len(x) - 1)
+    return x[samples], values[idx]
@@ -0,0 +1,37 @@
+import numpy as np
+
+# Time sorted interval index of the events of one ROI: event id and start, center and end sample of each event in
+# numpy arrays, sorted by start. "Which events are at this sample" and "which events overlap this range" are binary
+# searches (O(log n) plus the events that are found), e.g. for hovering, the visible range or a selected region.
+# Sample ranges are half open like python slices: an event has the samples start_idx ... end_idx - 1 (the samples of
+# trace[start_idx:end_idx], see Controller.cut_out_trace).
+
+
+class EventIndex:
+    def __init__(self, events):
+        event_ids = list(events)
+        start_idx = np.array([events[key]['start_idx'] for key in event_ids], dtype=np.int64)
+        order = np.argsort(start_idx, kind='stable')
+        self.event_ids = np.array(event_ids, dtype=np.int64)[order]
+        self.start_idx = start_idx[order]
+        self.center_idx = np.array([events[key]['center_idx'] for key in event_ids], dtype=np.int64)[order]
+        self.end_idx = np.array([events[key]['end_idx'] for key in event_ids], dtype=np.int64)[order]
+        # Largest end of all events up to each event (not decreasing): events before the first one that ends after a
+        # sample all end before it
+        self.max_end_idx = np.maximum.accumulate(self.end_idx) if len(self.end_idx) > 0 else self.end_idx
+
+    def __len__(self):
+        return len(self.event_ids)
+
+    def overlapping(self, start, stop):
+        # Ids of the events that have samples in start ... stop - 1, sorted by start
+        first = int(np.searchsorted(self.max_end_idx, start, side='right'))
+        last = int(np.searchsorted(self.start_idx, stop, side='left'))
+        if last <= first:
+            return []
+        hits = self.end_idx[first:last] > start
+        return self.event_ids[first:last][hits].tolist()
+
+    def at(self, sample):
+        # Ids of the events that contain this sample
+        return self.overlapping(sample, sample + 1)
@@ -0,0 +1,84 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+from scipy.signal import savgol_filter, butter, sosfiltfilt
+from viewer.normalization import running_percentile
+
+# Smoothing filters for the traces (1-D traces or rows of a (ROI x time) matrix, all rows are filtered in one call).
+# Every filter is a function (traces, window) -> filtered traces (float64), window is the filter length in samples.
+# New filters only have to be added to filter_bank (and get a name in filter_labels for the toolbar).
+
+
+def moving_average(traces, window):
+    # Box filter (running mean over window samples), same result as np.convolve(trace, np.ones(w) / w, mode='same')
+    # (samples outside of the trace count as 0). The sums are differences of the cumulative sum, so it costs the same
+    # for any window length. The cumulative sum is accumulated in float64 (also for float32 traces).
+    traces = np.asarray(traces)
+    n = traces.shape[-1]
+    window = max(1, min(int(window), n))
+    cum_sum = np.zeros(traces.shape[:-1] + (n + 1,), dtype=np.float64)
+    np.cumsum(traces, axis=-1, dtype=np.float64, out=cum_sum[..., 1:])
+
+    # Sample i is the sum of the samples i + (window - 1) // 2 - window + 1 ... i + (window - 1) // 2, divided by window
+    last = np.arange(n) + (window - 1) // 2
+    start = np.maximum(last - window + 1, 0)
+    stop = np.minimum(last, n - 1) + 1
+    return (cum_sum[..., stop] - cum_sum[..., start]) / window
+
+
+def savitzky_golay(traces, window, poly_order=3):
+    # Least squares polynomial fit in a sliding window: smooths but keeps the shape of fast rises and peaks
+    traces = np.asarray(traces, dtype=np.float64)
+    # Odd window length, longer than the polynomial order and not longer than the trace
+    window = min(int(window) // 2 * 2 + 1, traces.shape[-1] - (1 - traces.shape[-1] % 2))
+    if window <= poly_order:
+        return traces.copy()
+    return savgol_filter(traces, window, poly_order, axis=-1)
+
+
+def butterworth(traces, window, order=4):
+    # Zero-phase (forward and backward) low pass in second-order sections, no time shift of the transients.
+    # Cutoff: one cycle per window
+    traces = np.asarray(traces, dtype=np.float64)
+    if window <= 2:
+        return traces.copy()
+    # Cutoff relative to the Nyquist frequency
+    sos = butter(order, 2 / window, btype='lowpass', output='sos')
+    # sosfiltfilt needs the trace to be longer than its padding
+    pad_len = min(3 * (2 * len(sos) + 1), traces.shape[-1] - 1)
+    return sosfiltfilt(sos, traces, axis=-1, padlen=pad_len)
+
+
+def running_median(traces, window):
+    # Median in a sliding window (removes single sample spikes)
+    return running_percentile(traces, 50, window)
+
+
+def gaussian(traces, window):
+    # Gaussian kernel, the window covers +- 3 SD
+    traces = np.asarray(traces, dtype=np.float64)
+    return gaussian_filter1d(traces, max(window, 1) / 6, axis=-1, mode='nearest')
+
+
+filter_bank = {
+    'moving_average': moving_average,
+    'savitzky_golay': savitzky_golay,
+    'butterworth': butterworth,
+    'median': running_median,
+    'gaussian': gaussian,
+}
+
+# Linear filters: filter(a * x + b) = a * filter(x) + b * filter(1), normalized traces that are an affine transform of
+# the raw trace can be computed from the filtered raw trace
+linear_filters = ('moving_average', 'savitzky_golay', 'butterworth', 'gaussian')
+
+filter_labels = {
+    'moving_average': 'Moving Average',
+    'savitzky_golay': 'Savitzky-Golay',
+    'butterworth': 'Butterworth',
+    'median': 'Median',
+    'gaussian': 'Gaussian',
+}
+
+
+def apply_filter(filter_type, traces, window):
+    return filter_bank[filter_type](traces, window)
@@ -4,6 +4,7 @@ from PyQt6.QtWidgets import QMainWindow, QPushButton, QWidget, QLabel, QVBoxLayo
     QMessageBox, QHBoxLayout, QSlider, QComboBox, QToolBar, QLineEdit, QFileDialog, QDialog
 import pyqtgraph as pg
 from viewer.settings import SettingsFile
+from viewer.filters import filter_labels
 
 
 class ImportDataTracesWindow(QDialog):
@@ -146,11 +147,20 @@ class MainWindow(QMainWindow):
 
         # Filter Button
         self.toolbar_filter_action = QAction("Turn Filter ON", self)
-        self.toolbar_filter_action.setToolTip("Moving Average Filter (L)")
+        self.toolbar_filter_action.setToolTip("Filter (L)")
         self.toolbar.addAction(self.toolbar_filter_action)
         self.toolbar_filter_action.setDisabled(True)
         # self.shortcut_toolbar_filter_action = QShortcut(QKeySequence('L'), self)
 
+        # Filter Type (the name of the filter is the item data)
+        self.toolbar_filter_type = QComboBox()
+        self.toolbar_filter_type.setToolTip("Filter Type")
+        for filter_type, label in filter_labels.items():
+            self.toolbar_filter_type.addItem(label, filter_type)
+        filter_type_idx = self.toolbar_filter_type.findData(str(self.settings.get('filter_type')))
+        self.toolbar_filter_type.setCurrentIndex(max(filter_type_idx, 0))
+        self.toolbar.addWidget(self.toolbar_filter_type)
+
         self.toolbar.addSeparator()
 
         # Show Stimulus Button
@@ -256,6 +266,11 @@ class MainWindow(QMainWindow):
 
         self.file_menu.addSeparator()
         self.file_menu_action_import_traces = self.file_menu.addAction('Import Data Traces (ctrl+i)')
+        self.file_menu_action_import_planes = self.file_menu.addAction('Import Data Traces of several Planes (csv)')
+        self.file_menu_action_import_binary_traces = self.file_menu.addAction(
+            'Import Binary Data Traces (.npy, .npz, .raw)')
+        self.file_menu_action_import_suite2p = self.file_menu.addAction('Import Suite2p Folder')
+        self.file_menu_action_import_caiman = self.file_menu.addAction('Import CaImAn File (.hdf5)')
         self.file_menu_action_import_stimulus = self.file_menu.addAction('Import Stimulus (ctrl+b)')
         self.file_menu_action_import_stimulus_trace = self.file_menu.addAction('Import Stimulus Trace')
         self.file_menu_action_import_meta_data = self.file_menu.addAction('Import Meta Data (ctrl+m)')
@@ -264,6 +279,8 @@ class MainWindow(QMainWindow):
         self.file_menu_action_save_csv.setDisabled(True)
         self.file_menu_action_save_flags = self.file_menu.addAction('Export ROI Flags')
         self.file_menu_action_save_flags.setDisabled(True)
+        self.file_menu_action_save_filtered = self.file_menu.addAction('Export Filtered Traces to .csv')
+        self.file_menu_action_save_filtered.setDisabled(True)
         self.file_menu.addSeparator()
         self.file_menu_action_settings = self.file_menu.addAction('Settings')
         self.file_menu.addSeparator()
@@ -273,6 +290,9 @@ class MainWindow(QMainWindow):
         self.tools_menu = self.menu.addMenu('Tools')
         self.tools_menu_open_video_viewer = self.tools_menu.addAction('Open Video Viewer')
         self.tools_menu_multiplot = self.tools_menu.addAction('Multi Plot')
+        self.tools_menu_precompute = self.tools_menu.addAction('Precompute All Normalizations (for batch export)')
+        self.tools_menu_baseline_window = self.tools_menu.addAction('Running Baseline Window ...')
+        self.tools_menu_memory_limit = self.tools_menu.addAction('Memory Limit (Out-of-Core Mode) ...')
         self.tools_menu_video_converter = self.tools_menu.addAction('Convert Video File')
 
     def _setup_plot(self):
@@ -285,7 +305,8 @@ class MainWindow(QMainWindow):
 
         # Add a plot item to initialize plot window
         # Stimulus Plot
-        self.stimulus_plot_item = self.stimulus_graphics_layout_widget.addPlot(title='Stimulus', clear=True, name='stimulus')
+        self.stimulus_plot_item = self.stimulus_graphics_layout_widget.addPlot(
+            title='Stimulus', clear=True, name='stimulus')
         # self.stimulus_plot_item.setMenuEnabled(False)
         self.stimulus_plot_item.hideButtons()
         # Data Plot
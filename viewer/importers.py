@@ -0,0 +1,353 @@
+import os
+import json
+import struct
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+from zipfile import ZipFile, ZIP_STORED
+from PyQt6.QtCore import pyqtSignal, QObject
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def read_csv_header(file_dir):
+    # Only the column names (ROI names) of the csv file
+    return list(pd.read_csv(file_dir, index_col=False, nrows=0).keys())
+
+
+def count_csv_rows(file_dir, block_size=2 ** 24):
+    # Number of lines after the header, counted in the raw bytes (much faster than parsing the file)
+    n_lines = 0
+    last = b'\n'
+    with open(file_dir, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            n_lines += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        # Last line without a line break
+        n_lines += 1
+    return max(n_lines - 1, 0)
+
+
+def read_csv_traces(file_dir, dtype):
+    # The whole csv file as a (ROI x time) matrix (runs in a worker process)
+    return np.ascontiguousarray(pd.read_csv(file_dir, index_col=False, dtype=dtype).to_numpy().T)
+
+
+def get_plane_names(file_dirs):
+    # One name per file (imaging plane): the file name, or plane0, plane1, ... if the file names are not unique
+    names = [os.path.splitext(os.path.split(file_dir)[1])[0] for file_dir in file_dirs]
+    if len(set(names)) < len(names):
+        names = [f'plane{k}' for k in range(len(file_dirs))]
+    return names
+
+
+# ======================================================================================================================
+# BINARY TRACE FILES (.npy, .npz, raw)
+# ----------------------------------------------------------------------------------------------------------------------
+# The traces are memory mapped, so opening a file does not read it. ROI names, sampling rate and (for raw files) the
+# data type are taken from a sidecar json header next to the data file (same name, .json ending), e.g.:
+# {"sampling_rate": 30.0, "roi_list": ["ROI_1", "ROI_2"], "layout": "roi_major", "dtype": "float32"}
+# layout: "roi_major" (rows are ROIs, default) or "time_major" (columns are ROIs, like the csv files)
+binary_file_formats = ('.npy', '.npz', '.raw', '.bin')
+
+
+def read_sidecar_header(file_dir):
+    header_file = f'{os.path.splitext(file_dir)[0]}.json'
+    if os.path.exists(header_file):
+        with open(header_file, 'r') as f:
+            return json.load(f)
+    return dict()
+
+
+def open_npy_traces(file_dir):
+    return np.load(file_dir, mmap_mode='r')
+
+
+def open_npz_traces(file_dir, key=None):
+    with ZipFile(file_dir, 'r') as zip_object:
+        names = [n for n in zip_object.namelist() if n.endswith('.npy')]
+        if not names:
+            raise ValueError('Found no arrays in npz file')
+        name = names[0] if key is None else f'{key}.npy'
+        info = zip_object.getinfo(name)
+        if info.compress_type != ZIP_STORED:
+            # Compressed arrays can not be memory mapped and have to be loaded
+            with np.load(file_dir) as npz_file:
+                return npz_file[name[:-4]]
+
+    # Uncompressed members are plain .npy files inside the zip file: map them at their offset
+    with open(file_dir, 'rb') as f:
+        # Local file header: 30 bytes + file name + extra field
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    order = 'F' if fortran_order else 'C'
+    return np.memmap(file_dir, dtype=dtype, mode='r', offset=offset, shape=shape, order=order)
+
+
+def open_raw_traces(file_dir, header):
+    # Raw binary files are always little-endian
+    dtype = np.dtype(header.get('dtype', 'float32')).newbyteorder('<')
+    if 'n_rois' in header:
+        n_rois = int(header['n_rois'])
+    elif 'roi_list' in header:
+        n_rois = len(header['roi_list'])
+    else:
+        raise ValueError('The header of a raw file needs "n_rois" or "roi_list"')
+    file_size = os.path.getsize(file_dir)
+    if file_size % (n_rois * dtype.itemsize) != 0:
+        # The header does not fit the file (number of ROIs, data type)
+        raise ValueError(f'The size of {file_dir} ({file_size} bytes) is not a multiple of {n_rois} ROIs x '
+                         f'{dtype.itemsize} bytes ({dtype.name}), check the header')
+    n_samples = file_size // (n_rois * dtype.itemsize)
+    if header.get('layout', 'roi_major') == 'time_major':
+        shape = (n_samples, n_rois)
+    else:
+        shape = (n_rois, n_samples)
+    return np.memmap(file_dir, dtype=dtype, mode='r', shape=shape)
+
+
+def open_binary_traces(file_dir, header):
+    # Returns a (ROI x time) array that is memory mapped whenever possible
+    file_type = os.path.splitext(file_dir)[1].lower()
+    if file_type == '.npy':
+        traces = open_npy_traces(file_dir)
+    elif file_type == '.npz':
+        traces = open_npz_traces(file_dir, key=header.get('key'))
+    elif file_type in binary_file_formats:
+        traces = open_raw_traces(file_dir, header)
+    else:
+        raise ValueError(f'Unknown file type: {file_type}')
+
+    if traces.ndim != 2:
+        raise ValueError(f'Data traces must be a 2-D matrix, got {traces.ndim} dimensions')
+    if header.get('layout', 'roi_major') == 'time_major':
+        # Transposed view, no copy
+        traces = traces.T
+    return traces
+
+
+# ======================================================================================================================
+# SUITE2P AND CAIMAN RESULTS
+# ----------------------------------------------------------------------------------------------------------------------
+def open_suite2p_folder(folder):
+    # Suite2p plane folder (e.g. suite2p/plane0): F.npy and Fneu.npy are memory mapped (rows are ROIs)
+    f_file = os.path.join(folder, 'F.npy')
+    if not os.path.exists(f_file):
+        raise ValueError(f'Found no F.npy in {folder}')
+    result = {
+        'F': np.load(f_file, mmap_mode='r'),
+        'Fneu': None,
+        'iscell': None,
+        'ops': dict(),
+    }
+    if os.path.exists(os.path.join(folder, 'Fneu.npy')):
+        result['Fneu'] = np.load(os.path.join(folder, 'Fneu.npy'), mmap_mode='r')
+    if os.path.exists(os.path.join(folder, 'iscell.npy')):
+        result['iscell'] = np.load(os.path.join(folder, 'iscell.npy'))
+    if os.path.exists(os.path.join(folder, 'ops.npy')):
+        result['ops'] = np.load(os.path.join(folder, 'ops.npy'), allow_pickle=True).item()
+    return result
+
+
+def open_caiman_file(file_dir):
+    # CaImAn results (.hdf5): estimates/C (denoised traces) and estimates/YrA (residuals) stay in the file.
+    # The caller has to close the returned file.
+    f = h5py.File(file_dir, 'r')
+    estimates = f['estimates']
+    if 'C' not in estimates or estimates['C'].ndim != 2:
+        f.close()
+        raise ValueError('Found no traces (estimates/C) in this file')
+    result = {
+        'file': f,
+        'C': estimates['C'],
+        'YrA': estimates['YrA'] if 'YrA' in estimates and estimates['YrA'].shape == estimates['C'].shape else None,
+        'idx_components': None,
+        'fr': None,
+    }
+    if 'idx_components' in estimates and estimates['idx_components'].ndim == 1:
+        result['idx_components'] = estimates['idx_components'][()]
+    if 'params' in f and 'data' in f['params'] and 'fr' in f['params']['data']:
+        result['fr'] = float(f['params']['data']['fr'][()])
+    return result
+
+
+class CsvTraceImporter(QObject):
+    # Reads a csv file (columns: ROIs, rows: samples) in chunks and fills the raw matrix of a TraceStore.
+    # Meant to be moved to a QThread, all results are reported via signals.
+    progress = pyqtSignal(int)
+    first_roi_ready = pyqtSignal()
+    finished = pyqtSignal()
+    cancelled = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, file_dir, trace_store, chunk_size=10000, post_process=None):
+        QObject.__init__(self)
+        self.file_dir = file_dir
+        self.trace_store = trace_store
+        self.chunk_size = chunk_size
+        # Called in the worker thread after all traces are read (e.g. to normalize them)
+        self.post_process = post_process
+        self.dtype = trace_store.dtype
+        self._cancel = False
+
+    def cancel(self):
+        self._cancel = True
+
+    def run(self):
+        # Everything that goes wrong is reported, an exception must not leave the thread (PyQt would abort)
+        try:
+            self._read()
+        except Exception as e:
+            self.failed.emit(str(e) or type(e).__name__)
+
+    def get_chunk_size(self, n_rois):
+        if self.trace_store.memory_limit is None:
+            return self.chunk_size
+        # Out-of-core mode: pandas needs a few copies of each chunk, they have to fit into the memory limit
+        return int(max(1, min(self.chunk_size, self.trace_store.memory_limit // (4 * 8 * n_rois))))
+
+    def _read_chunks(self, file_dir, raw, first_row, n_rois, on_chunk):
+        # Reads a csv file chunk by chunk into the rows first_row ... first_row + n_rois - 1 of raw, on_chunk(samples)
+        # is called after each chunk. Returns the number of samples or None if the import was cancelled.
+        start = 0
+        with pd.read_csv(file_dir, index_col=False, dtype=self.dtype, chunksize=self.get_chunk_size(n_rois)) as reader:
+            for chunk in reader:
+                if self._cancel:
+                    return None
+                if chunk.shape[1] != n_rois:
+                    raise ValueError(f'{file_dir} has {chunk.shape[1]} columns, expected {n_rois}')
+                stop = start + chunk.shape[0]
+                if stop > raw.shape[1]:
+                    raise ValueError(f'{file_dir} has more than {raw.shape[1]} samples')
+                # csv columns are ROIs -> transpose into the ROI rows
+                raw[first_row:first_row + n_rois, start:stop] = chunk.to_numpy().T
+                start = stop
+                # Written pages of out-of-core files can be dropped from memory
+                self.trace_store.flush()
+                on_chunk(stop)
+        return start
+
+    def _read(self):
+        # One pass over the file: the sample count comes from counting the lines (no parsing), the matrix is filled
+        # chunk by chunk and the first ROI is shown after the first chunk while the rest is still loading
+        n_samples = count_csv_rows(self.file_dir)
+        raw = self.trace_store.allocate('raw', n_samples=n_samples)
+
+        first_chunk = True
+
+        def on_chunk(stop):
+            nonlocal first_chunk
+            if first_chunk:
+                first_chunk = False
+                self.first_roi_ready.emit()
+            self.progress.emit(int(100 * stop / max(n_samples, 1)))
+
+        n_read = self._read_chunks(self.file_dir, raw, 0, raw.shape[0], on_chunk)
+        if n_read is None:
+            self.cancelled.emit()
+            return
+        self._finish(raw, n_read)
+
+    def _finish(self, raw, n_samples):
+        if n_samples < raw.shape[1]:
+            # Blank lines are counted but are no samples
+            self.trace_store.set_matrix('raw', raw[:, :n_samples])
+        if self.post_process is not None:
+            self.post_process()
+        self.progress.emit(100)
+        self.finished.emit()
+
+
+class MultiCsvTraceImporter(CsvTraceImporter):
+    # Reads several csv files (e.g. one per imaging plane) in parallel worker processes. The ROIs of all files are
+    # stacked in file order into the raw matrix of one TraceStore (plane_sizes: number of ROIs per file), so the
+    # import takes about as long as the largest file. All files need the same number of samples.
+    # Out-of-core mode: the workers would load whole files, so the files are read one after the other in chunks that
+    # fit into the memory limit.
+    def __init__(self, file_dirs, plane_sizes, trace_store, max_workers=None, post_process=None):
+        CsvTraceImporter.__init__(self, None, trace_store, post_process=post_process)
+        self.file_dirs = list(file_dirs)
+        self.offsets = np.concatenate([[0], np.cumsum(plane_sizes)]).astype(int)
+        if not max_workers:
+            max_workers = os.cpu_count() or 1
+        self.max_workers = max(1, min(max_workers, len(self.file_dirs)))
+        # Seconds between two checks of the cancel flag while waiting for the workers
+        self.poll_interval = 0.1
+
+    def _read(self):
+        if self.trace_store.memory_limit is not None:
+            self._read_sequential()
+        else:
+            self._read_parallel()
+
+    def _read_sequential(self):
+        n_samples = count_csv_rows(self.file_dirs[0])
+        raw = self.trace_store.allocate('raw', n_samples=n_samples)
+        n_files = len(self.file_dirs)
+        n_read = None
+        first_chunk = True
+        for k, file_dir in enumerate(self.file_dirs):
+            def on_chunk(stop, k=k):
+                nonlocal first_chunk
+                if first_chunk:
+                    first_chunk = False
+                    self.first_roi_ready.emit()
+                self.progress.emit(int(100 * (k + stop / max(n_samples, 1)) / n_files))
+
+            n_file = self._read_chunks(file_dir, raw, self.offsets[k], self.offsets[k + 1] - self.offsets[k], on_chunk)
+            if n_file is None:
+                self.cancelled.emit()
+                return
+            if n_read is not None and n_file != n_read:
+                raise ValueError(f'{file_dir} has {n_file} samples, expected {n_read}')
+            n_read = n_file
+        self._finish(raw, n_read)
+
+    def _read_parallel(self):
+        # Spawned processes do not inherit the state of the GUI process (safe from a QThread on every platform)
+        executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            jobs = {executor.submit(read_csv_traces, file_dir, self.dtype): k
+                    for k, file_dir in enumerate(self.file_dirs)}
+            pending = set(jobs)
+            raw = None
+            while pending:
+                # The cancel flag is checked while the workers are still reading
+                done, pending = wait(pending, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                if self._cancel:
+                    self.cancelled.emit()
+                    return
+                for job in done:
+                    k = jobs[job]
+                    traces = job.result()
+                    if traces.shape[0] != self.offsets[k + 1] - self.offsets[k]:
+                        raise ValueError(f'Number of ROIs in {self.file_dirs[k]} changed while importing')
+                    if raw is None:
+                        raw = self.trace_store.allocate('raw', n_samples=traces.shape[1])
+                    elif traces.shape[1] != raw.shape[1]:
+                        raise ValueError(f'{self.file_dirs[k]} has {traces.shape[1]} samples, expected {raw.shape[1]}')
+                    raw[self.offsets[k]:self.offsets[k + 1]] = traces
+                    if k == 0:
+                        self.first_roi_ready.emit()
+                    self.progress.emit(int(100 * (len(jobs) - len(pending)) / len(jobs)))
+        except BrokenProcessPool as e:
+            raise OSError(f'An import process stopped unexpectedly: {e}')
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._finish(raw, raw.shape[1])
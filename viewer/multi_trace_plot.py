@@ -1,122 +1,122 @@
 import sys
-from PyQt6.QtCore import Qt, pyqtSignal
-from PyQt6.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QWidget, QScrollArea, QLabel, QProgressBar
+from PyQt6.QtCore import Qt, QEvent
+from PyQt6.QtWidgets import QApplication, QMainWindow, QHBoxLayout, QWidget, QScrollBar, QLabel, QSizePolicy
 import pyqtgraph as pg
 import numpy as np
+from viewer.plot_layers import DecimatedCurveItem
 
 
 class MultiPlotScrollArea(QMainWindow):
+    # Virtualized view of many traces: there are only plot rows for the traces that fit into the window, the rows are
+    # reused while scrolling. A row reads its trace when it is shown: get_trace(k) (e.g. a row of the trace store, no
+    # copy), get_pyramid(k) (optional min/max pyramid of the trace for the zoomed out view, see decimation.py).
 
-    row_finished = pyqtSignal(int)
-
-    def __init__(self, data, plot_height=200):
+    def __init__(self, num_plots, get_trace, get_label=None, get_pyramid=None, time_axis=None, plot_height=200):
         super().__init__()
-        self.num_plots = data.shape[0]
-        self.num_points = data.shape[1]
+        self.num_plots = num_plots
         self.plot_height = plot_height
-
-        # Generate some sample data
-        # self.data = [np.random.rand(self.num_points) for _ in range(self.num_plots)]
-        self.data = data
+        self.get_trace = get_trace
+        self.get_label = get_label if get_label is not None else lambda k: f'ROI {k}'
+        self.get_pyramid = get_pyramid
+        self.time_axis = time_axis
+        # Index of the trace in the first row
+        self.first_row = 0
+        # Row widgets: (row widget, label, plot widget, curve, index of the shown trace)
+        self.rows = []
 
         # Set up the main widget and layout
         self.central_widget = QWidget()
         self.setCentralWidget(self.central_widget)
+        layout = QHBoxLayout(self.central_widget)
 
-        layout = QVBoxLayout(self.central_widget)
-
-        # Create a scroll area and plot area widget
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)  # Allow the widget to resize
-        layout.addWidget(self.scroll_area)
-
-        # Create a widget to contain the vertically arranged plot widgets
+        # The rows (only as many as fit into the window). The rows are placed by update_rows and not by a layout, so
+        # the rows do not set a minimum height of the container and the window can be made smaller.
         self.plot_widget_container = QWidget()
-        self.scroll_area.setWidget(self.plot_widget_container)
-
-        # Set up the layout for the vertically arranged plot widgets
-        # The Plots
-        self.plot_layout = QVBoxLayout()
-        self.plot_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
-        # Create a plot widget for each trace and add them to the vertical layout
-        # This can take (block) some seconds
-
-        # self.progress_win = QWidget()
-        # self.progress = QProgressBar(self.progress_win)
-        # self.progress_win.show()
-        # self.progress.setMaximum(self.num_plots)
-        # self.progress.setGeometry(200, 80, 250, 20)
-
-        # self.plot_widgets = [pg.PlotWidget() for _ in range(self.num_plots)]
-
-        # self.plot_widgets = []
-        # for k in range(self.num_plots):
-        #     self.plot_widgets.append(pg.PlotWidget())
-        #
-        # for i, plot in enumerate(self.plot_widgets):
-        #     # Set a fixed height for each plot
-        #     plot.setMinimumHeight(self.plot_height)
-        #     plot_label = QLabel(f'ROI {i}')
-        #     row_layout = QHBoxLayout()
-        #     row_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
-        #     row_layout.addWidget(plot_label)
-        #     row_layout.addWidget(plot)
-        #     plot_layout.addLayout(row_layout)
-
-            # Set the x-axis range to the initial range with auto pan disabled
-            # plot.setXRange(0, self.num_points, padding=0)
-            # plot.enableAutoRange(axis=pg.ViewBox.YAxis, enable=True)
-            # plot.enableAutoRange(axis=pg.ViewBox.XAxis, enable=False)
-        self.plot_widget_container.setLayout(self.plot_layout)
-
-        # Connect the scroll bar's valueChanged signal to the update_plots function
-        # self.scroll_area.verticalScrollBar().valueChanged.connect(self.update_plots)
-
-        # Set the initial position of the scroll bar to 0 (topmost position)
-        self.scroll_area.verticalScrollBar().setValue(0)
-        self.plot_widgets = []
-
-        # self.scroll_area.horizontalScrollBar().setValue(0)
-
-        # Update the plots initially
-        # self.plot_data()
+        self.plot_widget_container.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
+        self.plot_widget_container.installEventFilter(self)
+        layout.addWidget(self.plot_widget_container)
+
+        # The scroll bar moves through the traces (one step: one row)
+        self.scroll_bar = QScrollBar(Qt.Orientation.Vertical)
+        self.scroll_bar.setValue(0)
+        self.scroll_bar.valueChanged.connect(self.set_first_row)
+        layout.addWidget(self.scroll_bar)
 
     def start(self):
-        self.plot_widgets = []
-        for k in range(self.num_plots):
-            self.plot_widgets.append(pg.PlotWidget())
-            self.row_finished.emit(k)
-
-        for i, plot in enumerate(self.plot_widgets):
-            # Set a fixed height for each plot
-            plot.setMinimumHeight(self.plot_height)
-            plot_label = QLabel(f'ROI {i}')
-            row_layout = QHBoxLayout()
-            row_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
-            row_layout.addWidget(plot_label)
-            row_layout.addWidget(plot)
-            self.plot_layout.addLayout(row_layout)
-
-        self.plot_data()
-
-    def plot_data(self):
-        # Loop over all traces and plot each of them into a separate plot item
-        for i, plot_widget in enumerate(self.plot_widgets):
-            y_data = self.data[i]
-            plot_widget.plot(y_data, pen=pg.mkPen(color='k'), clear=True)
-
-    def resizeEvent(self, event):
-        # Ensure the scroll bar remains at the top when resizing the window
-        self.scroll_area.verticalScrollBar().setValue(0)
-        # self.scroll_area.horizontalScrollBar().setValue(0)
-        super().resizeEvent(event)
+        self.update_rows()
+
+    def get_visible_row_count(self):
+        # Rows that fit completely into the window (at least one)
+        return max(1, min(self.num_plots, self.plot_widget_container.height() // self.plot_height))
+
+    def _create_row(self):
+        row_widget = QWidget(self.plot_widget_container)
+        row_layout = QHBoxLayout(row_widget)
+        row_layout.setContentsMargins(0, 0, 0, 0)
+        row_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
+        plot_label = QLabel()
+        plot = pg.PlotWidget()
+        curve = DecimatedCurveItem(pen=pg.mkPen(color='k'), skipFiniteCheck=True)
+        plot.addItem(curve)
+        row_layout.addWidget(plot_label)
+        row_layout.addWidget(plot)
+        return [row_widget, plot_label, plot, curve, None]
+
+    def update_rows(self):
+        n_visible = self.get_visible_row_count()
+        while len(self.rows) < n_visible:
+            self.rows.append(self._create_row())
+        # Delete the rows that do not fit anymore
+        while len(self.rows) > n_visible:
+            self.rows.pop()[0].deleteLater()
+
+        self.scroll_bar.setMaximum(max(0, self.num_plots - n_visible))
+        self.scroll_bar.setPageStep(n_visible)
+        self.first_row = min(self.first_row, self.scroll_bar.maximum())
+
+        for i, row in enumerate(self.rows):
+            k = self.first_row + i
+            row_widget, plot_label, plot, curve, shown = row
+            if k >= self.num_plots:
+                row_widget.hide()
+                continue
+            row_widget.setGeometry(0, i * self.plot_height, self.plot_widget_container.width(), self.plot_height)
+            if shown != k:
+                self._fill_row(row, k)
+            row_widget.show()
+
+    def _fill_row(self, row, k):
+        _, plot_label, plot, curve, _ = row
+        trace = self.get_trace(k)
+        time_axis = self.time_axis if self.time_axis is not None else np.arange(len(trace))
+        pyramid = self.get_pyramid(k) if self.get_pyramid is not None else None
+        plot_label.setText(self.get_label(k))
+        curve.set_full_data(time_axis, trace, pyramid=pyramid)
+        plot.enableAutoRange()
+        row[4] = k
+
+    def set_first_row(self, value):
+        self.first_row = value
+        self.update_rows()
+
+    def wheelEvent(self, event):
+        # Scroll one row per wheel step (inside the plots the wheel zooms)
+        steps = event.angleDelta().y() // 120
+        self.scroll_bar.setValue(self.scroll_bar.value() - steps)
+
+    def eventFilter(self, obj, event):
+        # Rows for the new size of the container
+        if obj is self.plot_widget_container and event.type() == QEvent.Type.Resize:
+            self.update_rows()
+        return super().eventFilter(obj, event)
 
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
-    num_plots = 10
+    num_plots = 1000
     num_points = 1000
-    data_set = np.array([np.random.rand(num_points) for _ in range(num_plots)])
-    window = MultiPlotScrollArea(data_set, plot_height=100)
+    data_set = np.random.rand(num_plots, num_points)
+    window = MultiPlotScrollArea(num_plots, get_trace=lambda k: data_set[k], plot_height=100)
+    window.start()
     window.show()
     sys.exit(app.exec())
@@ -0,0 +1,92 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.ndimage import percentile_filter
+
+# Whole population normalization: fbs (percentile baseline), dF/F, z-score and min/max of a (ROI x time) matrix.
+# The matrix is processed in blocks of ROIs that fit into the CPU cache, blocks run in a thread pool (numpy releases
+# the GIL in its loops, so the threads really run in parallel).
+# The baseline is either one percentile per ROI (fbs_window = 0) or a running percentile over a sliding window of
+# fbs_window samples (running F0, e.g. for recordings with photobleaching).
+
+# Target size of one block (bytes, float64)
+block_bytes = 2 ** 22
+
+
+def get_block_rows(n_samples, n_rois):
+    # Number of ROIs per block: at least one ROI, at most all
+    return int(min(max(1, block_bytes // (8 * max(n_samples, 1))), max(n_rois, 1)))
+
+
+def running_percentile(traces, percentile, window):
+    # Percentile over a sliding window (centered, edges: nearest value) of each trace (1-D or rows of a 2-D array).
+    # scipy's 1-D rank filter keeps the window sorted (O(n log w)), so it is applied row by row: a 2-D filter with
+    # size (1, w) would use the much slower n-D algorithm.
+    traces = np.asarray(traces, dtype=np.float64)
+    window = max(1, min(int(window), traces.shape[-1]))
+    if traces.ndim == 1:
+        return percentile_filter(traces, percentile, size=window, mode='nearest')
+    baseline = np.empty_like(traces)
+    for k in range(traces.shape[0]):
+        percentile_filter(traces[k], percentile, size=window, mode='nearest', output=baseline[k])
+    return baseline
+
+
+def normalize_block(block, fbs_percentile, fbs_window):
+    # fbs (per ROI), df, z and min_max of a block of raw traces (rows: ROIs), computed in float64
+    block = np.asarray(block, dtype=np.float64)
+
+    # Delta f over f
+    if fbs_window > 0:
+        block_base_line = running_percentile(block, fbs_percentile, fbs_window)
+        # One value per ROI: mean of the running baseline
+        block_fbs = np.mean(block_base_line, axis=1)
+    else:
+        block_fbs = np.percentile(block, fbs_percentile, axis=1)
+        block_base_line = block_fbs[:, np.newaxis]
+    block_df = (block - block_base_line) / block_base_line
+
+    # Z score
+    block_z = (block_df - np.mean(block_df, axis=1, keepdims=True)) / np.std(block_df, axis=1, keepdims=True)
+
+    # Min max norm
+    block_min = np.min(block, axis=1, keepdims=True)
+    block_max = np.max(block, axis=1, keepdims=True)
+    block_min_max = (block - block_min) / (block_max - block_min)
+    return block_fbs, block_df, block_z, block_min_max
+
+
+def _normalize_block(read_rows, start, stop, fbs_percentile, fbs_window, fbs, df, z, min_max):
+    # The block is computed in float64 and only stored in the precision of the output matrices
+    fbs[start:stop], df[start:stop], z[start:stop], min_max[start:stop] = normalize_block(
+        read_rows(start, stop), fbs_percentile, fbs_window)
+
+
+def normalize_matrix(read_rows, shape, fbs_percentile, fbs_window=0, dtype=np.float64, n_threads=None, out=None):
+    # read_rows(start, stop) -> raw traces of the ROIs start ... stop-1 (e.g. a slice of the raw matrix or memmap)
+    # fbs_window: samples of the running baseline (0: one percentile per ROI)
+    # out: (df, z, min_max) matrices the results are written to (e.g. memory mapped files), None: new arrays
+    # Returns fbs (per ROI) and the df, z and min_max matrices
+    n_rois, n_samples = shape
+    fbs = np.zeros(n_rois)
+    if out is None:
+        out = tuple(np.empty(shape, dtype=dtype) for _ in range(3))
+    df, z, min_max = out
+
+    block_rows = get_block_rows(n_samples, n_rois)
+    blocks = [(start, min(start + block_rows, n_rois)) for start in range(0, n_rois, block_rows)]
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    n_threads = max(1, min(n_threads, len(blocks)))
+
+    args = (fbs_percentile, fbs_window, fbs, df, z, min_max)
+    if n_threads == 1:
+        for start, stop in blocks:
+            _normalize_block(read_rows, start, stop, *args)
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            jobs = [executor.submit(_normalize_block, read_rows, start, stop, *args) for start, stop in blocks]
+            for job in jobs:
+                # Raises errors of the worker threads
+                job.result()
+    return fbs, df, z, min_max
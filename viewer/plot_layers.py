@@ -0,0 +1,413 @@
+import numpy as np
+import pyqtgraph as pg
+from PyQt6.QtCore import Qt, QRectF, QPointF, pyqtSignal
+from viewer.settings import PlottingStyles
+from viewer.decimation import min_max_envelope, pyramid_envelope, get_pyramid_bounds
+
+# Named layers of the main trace plot (data trace, filtered trace, stimulus onsets, events, fits, baseline, video
+# cursor, ...). A layer keeps its graphics items: they are updated in place (setData, setPos) and shown or hidden,
+# instead of clearing the whole plot and creating every item again on each redraw.
+
+
+class PlotLayer:
+    # A group of graphics items (an item can also be in another plot item, e.g. the stimulus plot)
+    def __init__(self, plot_item):
+        self.plot_item = plot_item
+        self.items = []
+        self.visible = True
+
+    def add(self, item, plot_item=None, ignore_bounds=False):
+        if plot_item is None:
+            plot_item = self.plot_item
+        plot_item.addItem(item, ignoreBounds=ignore_bounds)
+        item.setVisible(self.visible)
+        self.items.append((plot_item, item))
+        return item
+
+    def get_items(self):
+        return [item for _, item in self.items]
+
+    def set_visible(self, visible):
+        self.visible = bool(visible)
+        for _, item in self.items:
+            item.setVisible(self.visible)
+
+    def clear(self):
+        for plot_item, item in self.items:
+            plot_item.removeItem(item)
+        self.items = []
+
+
+class DecimatedCurveItem(pg.PlotDataItem):
+    # Curve of a long trace: the full trace is kept, but only the min/max envelope of the visible x range (one column
+    # per pixel) is drawn. The envelope is computed again when the x range of the view (or its size) changes.
+    # With a min/max pyramid (read_bins(start, stop), see decimation.py) zoomed out views only read the pyramid.
+    # Default number of columns as long as the curve is not in a view
+    default_columns = 4096
+
+    def __init__(self, x=None, y=None, **kwargs):
+        pg.PlotDataItem.__init__(self, **kwargs)
+        self.x_full = None
+        self.y_full = None
+        self.y_bounds = None
+        self.read_bins = None
+        # (x min, x max, columns) of the shown envelope
+        self.envelope_key = None
+        if x is not None:
+            self.set_full_data(x, y)
+
+    def set_full_data(self, x, y, pyramid=None):
+        self.x_full = np.asarray(x)
+        self.y_full = np.asarray(y)
+        self.read_bins = pyramid
+        if len(self.y_full) > 0 and pyramid is not None:
+            self.y_bounds = get_pyramid_bounds(len(self.y_full), pyramid)
+        elif len(self.y_full) > 0:
+            self.y_bounds = (np.nanmin(self.y_full), np.nanmax(self.y_full))
+        else:
+            self.y_bounds = None
+        self.envelope_key = None
+        self.update_envelope()
+
+    def update_envelope(self):
+        if self.x_full is None:
+            return
+        if len(self.x_full) == 0:
+            self.setData([], [])
+            return
+        view_box = self.getViewBox()
+        if view_box is None or view_box.width() < 1:
+            x_min, x_max = self.x_full[0], self.x_full[-1]
+            n_columns = self.default_columns
+        else:
+            x_min, x_max = view_box.viewRange()[0]
+            n_columns = int(view_box.width())
+        key = (float(x_min), float(x_max), n_columns)
+        if key == self.envelope_key:
+            return
+        self.envelope_key = key
+        if self.read_bins is None:
+            x, y = min_max_envelope(self.x_full, self.y_full, x_min, x_max, n_columns)
+        else:
+            x, y = pyramid_envelope(self.x_full, x_min, x_max, n_columns, self._read_samples, self.read_bins)
+        self.setData(x, y)
+
+    def _read_samples(self, start, stop):
+        return self.y_full[start:stop]
+
+    def viewRangeChanged(self, vb=None, ranges=None, changed=None):
+        # changed: [x changed, y changed], None: the size of the view changed
+        if changed is None or changed[0]:
+            self.update_envelope()
+        pg.PlotDataItem.viewRangeChanged(self, vb, ranges, changed)
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        # Bounds of the full trace (not of the envelope), so that auto range shows the whole trace
+        if self.x_full is None or len(self.x_full) == 0 or self.y_bounds is None:
+            return pg.PlotDataItem.dataBounds(self, ax, frac, orthoRange)
+        if ax == 0:
+            return self.x_full[0], self.x_full[-1]
+        return self.y_bounds
+
+
+class CurveLayer(PlotLayer):
+    # A layer with one (decimated) curve
+    def __init__(self, plot_item, name, pen=None):
+        PlotLayer.__init__(self, plot_item)
+        self.curve = self.add(DecimatedCurveItem(name=name, pen=pen, skipFiniteCheck=True, tip=None))
+
+    def set_data(self, x, y, pyramid=None):
+        self.curve.set_full_data(x, y, pyramid=pyramid)
+
+    def set_pen(self, pen):
+        self.curve.setPen(pen)
+
+
+class MultiCurveItem(pg.GraphicsObject):
+    # Many short curves that are parts of one trace (e.g. the events of a ROI), each with its own pen, in one item.
+    # A curve is the sample range start ... stop - 1 of the trace (x, y are the whole trace, no copies are kept). The
+    # curves in a time range are found with find_keys(x_min, x_max) (e.g. an EventIndex, see event_index.py): paint
+    # only draws the curves in view and hover and click only test the curves at the mouse position, instead of one Qt
+    # item per curve.
+    # Signals: key of the curve and the mouse event
+    sigCurveHovered = pyqtSignal(object, object)
+    sigCurveNotHovered = pyqtSignal(object, object)
+    sigCurveClicked = pyqtSignal(object, object)
+    # Max. distance of the mouse from a curve (pixels)
+    tolerance = 5
+
+    # The view range changed (e.g. to update other items that only show the curves in view)
+    sigViewRangeChanged = pyqtSignal()
+
+    def __init__(self, hoverable=True):
+        pg.GraphicsObject.__init__(self)
+        self.hoverable = hoverable
+        self.setAcceptHoverEvents(hoverable)
+        self.hovered = None
+        # None: all curves are tested
+        self.find_keys = None
+        self.set_curves(np.zeros(0), np.zeros(0), [], [], [], [])
+
+    def set_curves(self, x, y, keys, starts, stops, pens, hover_pens=None):
+        # x, y: the whole trace (x sorted), starts, stops: sample range of each curve
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.spans = {key: (int(start), int(stop)) for key, start, stop in zip(keys, starts, stops)}
+        self.pens = dict(zip(keys, pens))
+        self.hover_pens = self.pens if hover_pens is None else dict(zip(keys, hover_pens))
+        # QPainterPath of each curve, created when it is drawn for the first time
+        self.paths = dict()
+        self.hovered = None
+        self.bounds = QRectF()
+        spans = [(start, stop) for start, stop in self.spans.values() if stop > start]
+        if len(spans) > 0:
+            x_min, x_max = self.x[min(start for start, _ in spans)], self.x[max(stop for _, stop in spans) - 1]
+            y_min = min(np.nanmin(self.y[start:stop]) for start, stop in spans)
+            y_max = max(np.nanmax(self.y[start:stop]) for start, stop in spans)
+            self.bounds = QRectF(x_min, y_min, x_max - x_min, y_max - y_min)
+        self.prepareGeometryChange()
+        self.update()
+
+    def get_curve(self, key):
+        start, stop = self.spans[key]
+        return self.x[start:stop], self.y[start:stop]
+
+    def find_curves(self, x_min, x_max):
+        # Keys of the curves that overlap x_min ... x_max
+        if self.find_keys is None:
+            return list(self.spans)
+        return [key for key in self.find_keys(x_min, x_max) if key in self.spans]
+
+    def curve_at(self, pos):
+        # Key of the curve closest to pos (item coordinates) within the tolerance, None if there is none
+        pixel_width, pixel_height = self.pixelWidth(), self.pixelHeight()
+        if len(self.spans) == 0 or pixel_width == 0 or pixel_height == 0:
+            return None
+        x, y = pos.x(), pos.y()
+        dx = self.tolerance * pixel_width
+        best, best_distance = None, self.tolerance
+        for key in self.find_curves(x - dx, x + dx):
+            curve_x, curve_y = self.get_curve(key)
+            if len(curve_x) == 0:
+                continue
+            # Samples close to the mouse and the curve right at the mouse position
+            near = slice(np.searchsorted(curve_x, x - dx), np.searchsorted(curve_x, x + dx, side='right'))
+            px = np.append(curve_x[near], x)
+            py = np.append(curve_y[near], np.interp(x, curve_x, curve_y))
+            distance = np.nanmin(np.hypot((px - x) / pixel_width, (py - y) / pixel_height))
+            if distance <= best_distance:
+                best, best_distance = key, distance
+        return best
+
+    def boundingRect(self):
+        return self.bounds
+
+    def viewRangeChanged(self, *args):
+        pg.GraphicsObject.viewRangeChanged(self)
+        self.sigViewRangeChanged.emit()
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        if self.bounds.isNull():
+            return None, None
+        if ax == 0:
+            return self.bounds.left(), self.bounds.right()
+        return self.bounds.top(), self.bounds.bottom()
+
+    def paint(self, p, *args):
+        view_rect = self.viewRect()
+        if view_rect is None or len(self.spans) == 0:
+            return
+        for key in self.find_curves(view_rect.left(), view_rect.right()):
+            if key not in self.paths:
+                self.paths[key] = pg.arrayToQPath(*self.get_curve(key))
+            p.setPen(self.hover_pens[key] if key == self.hovered else self.pens[key])
+            p.drawPath(self.paths[key])
+
+    def hoverEvent(self, ev):
+        if ev.isExit():
+            key = None
+        else:
+            key = self.curve_at(ev.pos())
+        if key == self.hovered:
+            return
+        if self.hovered is not None:
+            self.sigCurveNotHovered.emit(self.hovered, ev)
+        self.hovered = key
+        if key is not None:
+            self.sigCurveHovered.emit(key, ev)
+        self.update()
+
+    def mouseClickEvent(self, ev):
+        key = self.curve_at(ev.pos()) if self.hoverable else None
+        if key is None:
+            ev.ignore()
+            return
+        ev.accept()
+        self.sigCurveClicked.emit(key, ev)
+
+
+class EventsLayer(PlotLayer):
+    # All events of a ROI in a few items: event traces (hover and click), filtered event traces, the points of all
+    # events and the rise and decay fits (one curve each, the fits of the events are separated by NaN). Like the event
+    # traces, points and fits only get the events in view (found with the same find_keys), they are set again when the
+    # view range changes.
+    def __init__(self, plot_item):
+        PlotLayer.__init__(self, plot_item)
+        self.curves = self.add(MultiCurveItem())
+        self.filtered_curves = self.add(MultiCurveItem(hoverable=False))
+        self.points = self.add(pg.ScatterPlotItem(
+            symbol='d', pen=pg.mkPen(color='b', width=2), brush=pg.mkBrush(color='g'), size=15, tip=None))
+        self.rise_fits = self.add(pg.PlotDataItem(
+            pen=PlottingStyles.fit_rise_pen, shadowPen=PlottingStyles.fit_rise_shadow_pen, connect='finite', tip=None))
+        self.decay_fits = self.add(pg.PlotDataItem(
+            pen=PlottingStyles.fit_decay_pen, shadowPen=PlottingStyles.fit_decay_shadow_pen, connect='finite',
+            tip=None))
+        # key -> (x, y) of the points, the rise fit and the decay fit of each event
+        self.event_points = dict()
+        self.event_rise_fits = dict()
+        self.event_decay_fits = dict()
+        # Keys of the events the points and fits are set for (None: not set yet)
+        self.shown_keys = None
+        self.curves.sigViewRangeChanged.connect(self.update_visible)
+
+    def set_index(self, find_keys):
+        # find_keys(x_min, x_max): ids of the events in a time range
+        self.curves.find_keys = find_keys
+        self.filtered_curves.find_keys = find_keys
+
+    @staticmethod
+    def _join(curves):
+        # One array of x and y for many curves, separated by NaN
+        if len(curves) == 0:
+            return np.zeros(0), np.zeros(0)
+        x = np.concatenate([np.append(np.asarray(t, dtype=np.float64), np.nan) for t, _ in curves])
+        y = np.concatenate([np.append(np.asarray(v, dtype=np.float64), np.nan) for _, v in curves])
+        return x, y
+
+    def set_events(self, x, y, filtered_y, keys, starts, stops, pens, hover_pens, filtered_pens, points, rise_fits,
+                   decay_fits):
+        # x, y: time axis and trace of the ROI, filtered_y: filtered trace (None: no filtered event traces), starts,
+        # stops: sample range of each event, points, rise_fits and decay_fits: (x, y) of each event
+        self.curves.set_curves(x, y, keys, starts, stops, pens, hover_pens)
+        if filtered_y is None:
+            self.filtered_curves.set_curves(np.zeros(0), np.zeros(0), [], [], [], [])
+        else:
+            self.filtered_curves.set_curves(x, filtered_y, keys, starts, stops, filtered_pens)
+        self.event_points = dict(zip(keys, points))
+        self.event_rise_fits = dict(zip(keys, rise_fits))
+        self.event_decay_fits = dict(zip(keys, decay_fits))
+        self.shown_keys = None
+        self.update_visible()
+
+    def update_visible(self):
+        # Points and fits of the events in view
+        # The range of the view box, viewRect() of the item can still be the old one when the view range changed
+        view_box = self.curves.getViewBox()
+        if view_box is None:
+            keys = list(self.event_points)
+        else:
+            x_min, x_max = view_box.viewRange()[0]
+            keys = [key for key in self.curves.find_curves(x_min, x_max) if key in self.event_points]
+        if keys == self.shown_keys:
+            return
+        self.shown_keys = keys
+        points_x, points_y = self._join([self.event_points[key] for key in keys])
+        # No NaN separators for the points
+        self.points.setData(x=points_x[np.isfinite(points_x)], y=points_y[np.isfinite(points_x)])
+        self.rise_fits.setData(*self._join([self.event_rise_fits[key] for key in keys]), connect='finite')
+        self.decay_fits.setData(*self._join([self.event_decay_fits[key] for key in keys]), connect='finite')
+
+
+class TextLabelsItem(pg.GraphicsObject):
+    # Many text boxes in one item (e.g. the names of all stimuli): they are drawn in one paint call, with a fixed
+    # size on screen and their top left corner at (x, y). The labels are kept sorted by x, the labels inside the view
+    # are found with a binary search and only they are drawn.
+    padding = 2
+
+    def __init__(self, color='k', border='k', fill='w'):
+        pg.GraphicsObject.__init__(self)
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self.texts = []
+        self.text_pen = pg.mkPen(color=color)
+        self.border_pen = pg.mkPen(color=border)
+        self.fill_brush = pg.mkBrush(color=fill)
+
+    def set_labels(self, x, y, texts):
+        x = np.asarray(x, dtype=np.float64)
+        order = np.argsort(x, kind='stable')
+        self.x = x[order]
+        self.y = np.broadcast_to(np.asarray(y, dtype=np.float64), x.shape)[order]
+        texts = [str(text) for text in texts]
+        self.texts = [texts[k] for k in order]
+        self.update()
+
+    def boundingRect(self):
+        # The labels have a fixed size in pixels, so the item covers the whole view
+        view_rect = self.viewRect()
+        if view_rect is None:
+            return QRectF()
+        return view_rect
+
+    def viewRangeChanged(self, *args):
+        self.prepareGeometryChange()
+        pg.GraphicsObject.viewRangeChanged(self)
+
+    def paint(self, p, *args):
+        view_rect = self.viewRect()
+        if view_rect is None or len(self.x) == 0:
+            return
+        # The label left of the view can still reach into it
+        first = max(int(np.searchsorted(self.x, view_rect.left(), side='left')) - 1, 0)
+        last = int(np.searchsorted(self.x, view_rect.right(), side='right'))
+        # Draw in pixel coordinates
+        transform = p.transform()
+        p.resetTransform()
+        metrics = p.fontMetrics()
+        for k in range(first, last):
+            pos = transform.map(QPointF(self.x[k], self.y[k]))
+            text_rect = metrics.boundingRect(self.texts[k])
+            box = QRectF(pos.x(), pos.y(), text_rect.width() + 2 * self.padding,
+                         text_rect.height() + 2 * self.padding)
+            p.setPen(self.border_pen)
+            p.setBrush(self.fill_brush)
+            p.drawRect(box)
+            p.setPen(self.text_pen)
+            p.drawText(box, Qt.AlignmentFlag.AlignCenter, self.texts[k])
+
+
+class SegmentsLayer(PlotLayer):
+    # Vertical lines (e.g. all stimulus onsets) as one curve of unconnected pairs of points
+    def __init__(self, plot_item, name, pen=None):
+        PlotLayer.__init__(self, plot_item)
+        self.curve = self.add(pg.PlotDataItem(name=name, pen=pen, connect='pairs', skipFiniteCheck=True, tip=None))
+
+    def set_lines(self, x, y_min, y_max):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.empty(2 * len(x))
+        y[0::2] = y_min
+        y[1::2] = y_max
+        self.curve.setData(np.repeat(x, 2), y, connect='pairs')
+
+
+class LabelsLayer(PlotLayer):
+    # Text labels of one TextLabelsItem, they do not change the auto range of the plot
+    def __init__(self, plot_item, color='k', border='k', fill='w'):
+        PlotLayer.__init__(self, plot_item)
+        self.labels = self.add(TextLabelsItem(color=color, border=border, fill=fill), ignore_bounds=True)
+
+    def set_labels(self, x, y, texts):
+        self.labels.set_labels(x, y, texts)
+
+
+def create_trace_plot_layers(plot_item):
+    # Drawing order: the first layer is at the bottom
+    return {
+        'data': CurveLayer(plot_item, 'data_trace'),
+        'filtered': CurveLayer(plot_item, 'filtered_trace', pen=pg.mkPen(color='r')),
+        'stimulus_onsets': SegmentsLayer(plot_item, 'stimulus_onsets', pen=pg.mkPen(color='b', width=1)),
+        'stimulus_info': LabelsLayer(plot_item),
+        'events': EventsLayer(plot_item),
+        'baseline': CurveLayer(plot_item, 'base_line', pen=pg.mkPen(color='g', width=3)),
+        'video': PlotLayer(plot_item),
+    }
@@ -0,0 +1,242 @@
+import os
+import json
+import numpy as np
+from viewer.decimation import build_pyramid, get_pyramid_size
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+"""
+HDF5 Session File:
+.
+├── roi_list
+├── fbs
+├── traces (rows: ROIs, one chunk per ROI row)
+│   ├── raw
+│   ├── df
+│   ├── z
+│   └── min_max
+├── pyramids (min/max LOD pyramid of each trace, rows: ROIs, see decimation.py)
+│   ├── raw
+│   :
+├── events
+│   ├── roi index
+│   :   ├── event id (arrays as datasets, everything else as json attribute)
+│
+├── stimulus_traces
+│   └── roi index
+├── extra_traces
+│   └── roi index
+│       └── trace name
+└── meta
+    ├── roi_flags
+    ├── stimulus
+    └── info
+
+Attributes: data_name, sampling_rate, fbs_percentile, fbs_window, filter_window
+"""
+
+h5_file_formats = ('.h5', '.hdf5')
+# Max. samples per chunk (a chunk never spans more than one ROI)
+chunk_samples = 2 ** 18
+
+
+def h5_available():
+    return h5py is not None
+
+
+def _to_json(value):
+    # numpy values as plain python values
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def _write_dict(group, values):
+    # Arrays become datasets, everything else is stored as json in an attribute
+    plain_values = dict()
+    for key, value in values.items():
+        if isinstance(value, np.ndarray) and value.ndim > 0 and value.dtype != object:
+            group.create_dataset(key, data=value)
+        else:
+            plain_values[key] = value
+    group.attrs['json'] = json.dumps(plain_values, default=_to_json)
+    # json has no tuples (e.g. pen colors): their keys are stored, so that they are tuples again after loading
+    group.attrs['tuples'] = json.dumps([key for key, value in plain_values.items() if isinstance(value, tuple)])
+
+
+def _read_dict(group):
+    values = json.loads(group.attrs['json'])
+    if 'tuples' in group.attrs:
+        tuple_keys = set(json.loads(group.attrs['tuples']))
+    else:
+        # Older session files: all lists were tuples
+        tuple_keys = {key for key, value in values.items() if isinstance(value, list)}
+    values = {key: tuple(value) if key in tuple_keys else value for key, value in values.items()}
+    for key in group:
+        values[key] = group[key][()]
+    return values
+
+
+def is_read_only(file_dir, data_handler):
+    # Saving to the session file that is open, but it could only be opened for reading
+    session_file = data_handler.session_file
+    return (session_file is not None and os.path.abspath(session_file.filename) == os.path.abspath(file_dir)
+            and session_file.mode == 'r')
+
+
+def save_session_h5(file_dir, data_handler, compression=None):
+    session_file = data_handler.session_file
+    if session_file is not None and os.path.abspath(session_file.filename) == os.path.abspath(file_dir):
+        if session_file.mode == 'r':
+            raise OSError(f'{file_dir} is read-only')
+        # This session was loaded from this file: the raw traces are already there, update the normalization (fbs
+        # settings may have changed) and the annotations
+        _update_traces(session_file, data_handler, compression)
+        _write_annotations(session_file, data_handler)
+        session_file.flush()
+        return
+
+    with h5py.File(file_dir, 'w') as f:
+        _write_traces(f, data_handler, compression)
+        _write_annotations(f, data_handler)
+
+
+def _write_fbs(f, data_handler):
+    store = data_handler.trace_store
+    f.attrs['fbs_percentile'] = data_handler.fbs_per
+    f.attrs['fbs_window'] = data_handler.fbs_window
+    if 'fbs' in f:
+        del f['fbs']
+    f.create_dataset('fbs', data=np.array([store.get_fbs(roi) for roi in store.roi_list], dtype=np.float64))
+
+
+def _write_mode(traces, pyramids, store, mode, compression):
+    roi_list = store.roi_list
+    n_rois, n_samples = store.get_roi_count(), store.n_samples
+    n_bins = get_pyramid_size(n_samples)
+    dtype = np.asarray(store.row(mode, roi_list[0])).dtype
+    data_set = traces.create_dataset(
+        mode, shape=(n_rois, n_samples), dtype=dtype, chunks=(1, min(n_samples, chunk_samples)),
+        compression=compression, shuffle=compression is not None)
+    pyramid_set = pyramids.create_dataset(
+        mode, shape=(n_rois, n_bins, 2), dtype=dtype, chunks=(1, min(n_bins, chunk_samples // 2), 2),
+        compression=compression, shuffle=compression is not None)
+    # Row by row, so traces that are on disk are never loaded all at once
+    for k, roi in enumerate(roi_list):
+        trace = store.row(mode, roi)
+        data_set[k] = trace
+        pyramid_set[k] = build_pyramid(trace)
+
+
+def _write_traces(f, data_handler, compression):
+    store = data_handler.trace_store
+    f.create_dataset('roi_list', data=[str(roi) for roi in store.roi_list], dtype=h5py.string_dtype())
+    traces = f.create_group('traces')
+    pyramids = f.create_group('pyramids')
+    for mode in store.get_modes():
+        _write_mode(traces, pyramids, store, mode, compression)
+    _write_fbs(f, data_handler)
+
+
+def _update_traces(f, data_handler, compression):
+    # Normalized traces in the file that are not the ones of the trace store anymore (e.g. df and z after the fbs
+    # percentile changed) are written again if the store has them for all ROIs, otherwise they are removed and
+    # derived from the raw traces after loading
+    store = data_handler.trace_store
+    traces = f['traces']
+    pyramids = f.require_group('pyramids')
+    for mode in store.norm_modes:
+        matrix = store.matrices.get(mode)
+        if mode in traces and isinstance(matrix, h5py.Dataset) and matrix.id == traces[mode].id:
+            continue
+        if mode == 'raw':
+            raise ValueError('The raw traces of this session are not the ones of the file')
+        for group in [traces, pyramids]:
+            if mode in group:
+                del group[mode]
+        if store.has_mode(mode):
+            _write_mode(traces, pyramids, store, mode, compression)
+    _write_fbs(f, data_handler)
+
+
+def _write_annotations(f, data_handler):
+    for name in ['events', 'stimulus_traces', 'extra_traces', 'meta']:
+        if name in f:
+            del f[name]
+    roi_list = data_handler.meta_data['roi_list']
+    f.attrs['data_name'] = data_handler.data_name or ''
+    f.attrs['sampling_rate'] = data_handler.meta_data['sampling_rate']
+    f.attrs['filter_window'] = json.dumps(data_handler.filter_window)
+
+    events = f.create_group('events')
+    stimulus_traces = f.create_group('stimulus_traces')
+    extra_traces = f.create_group('extra_traces')
+    for k, roi in enumerate(roi_list):
+        roi_data = data_handler.data[roi]
+        if roi_data[data_handler.events_key]:
+            roi_events = events.create_group(str(k))
+            for event_id, event in roi_data[data_handler.events_key].items():
+                _write_dict(roi_events.create_group(str(event_id)), event)
+        if roi_data[data_handler.stimulus_traces_key]:
+            stimulus_trace = {
+                key: np.asarray(value) for key, value in roi_data[data_handler.stimulus_traces_key].items()}
+            _write_dict(stimulus_traces.create_group(str(k)), stimulus_trace)
+        for name, extra_trace in roi_data[data_handler.extra_traces_key].items():
+            extra_trace = {key: np.asarray(value) if key != 'sampling_rate' else value
+                           for key, value in extra_trace.items()}
+            _write_dict(extra_traces.create_group(f'{k}/{name}'), extra_trace)
+
+    meta = f.create_group('meta')
+    flags = data_handler.meta_data['roi_flags']
+    meta.create_dataset('roi_flags', data=np.array([bool(flags[roi]) for roi in roi_list]))
+    _write_dict(meta.create_group('stimulus'), data_handler.meta_data['stimulus'])
+    info = {key: value for key, value in data_handler.meta_data.items()
+            if key not in ['roi_list', 'roi_flags', 'stimulus', 'sampling_rate']}
+    _write_dict(meta.create_group('info'), info)
+
+
+def load_session_h5(file_dir, data_handler):
+    # The file stays open: traces are read per ROI when they are needed. Returns the filter window.
+    try:
+        f = h5py.File(file_dir, 'r+')
+    except OSError:
+        # e.g. a read-only file
+        f = h5py.File(file_dir, 'r')
+    roi_list = list(f['roi_list'].asstr()[()])
+    traces = f['traces']
+    data_handler.fbs_per = float(f.attrs['fbs_percentile'])
+    data_handler.fbs_window = float(f.attrs.get('fbs_window', 0))
+    data_handler.create_new_data_set(
+        roi_list=roi_list, data_name=str(f.attrs['data_name']), sampling_rate=float(f.attrs['sampling_rate']),
+        n_samples=traces['raw'].shape[1])
+    for mode in traces:
+        data_handler.add_mapped_data_matrix(traces[mode], norm_mode=mode)
+    # Older session files have no pyramids, they are then built in the background
+    if 'pyramids' in f:
+        for mode in f['pyramids']:
+            data_handler.trace_store.attach_pyramid(mode, f['pyramids'][mode])
+    data_handler.trace_store.fbs[:] = f['fbs'][()]
+    data_handler.session_file = f
+
+    for k, roi in enumerate(roi_list):
+        roi_data = data_handler.data[roi]
+        if str(k) in f['events']:
+            roi_events = f['events'][str(k)]
+            event_ids = sorted(int(event_id) for event_id in roi_events)
+            roi_data[data_handler.events_key] = {
+                event_id: _read_dict(roi_events[str(event_id)]) for event_id in event_ids}
+        if str(k) in f['stimulus_traces']:
+            roi_data[data_handler.stimulus_traces_key] = _read_dict(f['stimulus_traces'][str(k)])
+        if str(k) in f['extra_traces']:
+            for name, extra_trace in f['extra_traces'][str(k)].items():
+                roi_data[data_handler.extra_traces_key][name] = _read_dict(extra_trace)
+
+    meta = f['meta']
+    data_handler.meta_data['roi_flags'] = dict(zip(roi_list, meta['roi_flags'][()].tolist()))
+    data_handler.meta_data['stimulus'] = _read_dict(meta['stimulus'])
+    data_handler.meta_data.update(_read_dict(meta['info']))
+    return json.loads(f.attrs['filter_window'])
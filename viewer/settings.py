@@ -42,6 +42,22 @@ class SettingsMenu(QMainWindow):
 
 
 class SettingsFile:
+    # Settings added later on: used when creating a new settings file and when an older file does not have them
+    defaults = {
+        'h5_compression': 'gzip',
+        'trace_cache_size': 64,
+        'precompute_normalizations': 0,
+        'normalization_threads': 0,
+        'fbs_window': 0,
+        'precision': 'float64',
+        'import_processes': 0,
+        'memory_limit_mb': 0,
+        'out_of_core_dir': 'NaN',
+        'filter_type': 'moving_average',
+        'prefetch_rois': 2,
+        'filter_debounce_ms': 150,
+    }
+
     def __init__(self):
         f = os.listdir(os.getcwd() + '/viewer')
         if 'settings.csv' in f:
@@ -67,6 +83,8 @@ class SettingsFile:
             self.settings_file.loc['filter_max'] = 10 * 1000
             self.settings_file.loc['filter_interval'] = 10
             self.settings_file.loc['filter_default'] = 5 * 1000
+            for key, value in self.defaults.items():
+                self.settings_file.loc[key] = value
 
             # self.settings_file.to_csv('viewer/settings.csv')
             self.save_settings()
@@ -78,6 +96,8 @@ class SettingsFile:
         self.settings_file.loc[index_name] = value
 
     def get(self, key_name):
+        if key_name not in self.settings_file.index:
+            return self.defaults[key_name]
         if key_name == 'default_dir':
             out = Path(self.settings_file.loc[key_name].item())
         else:
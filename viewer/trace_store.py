@@ -0,0 +1,456 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import numpy as np
+from viewer.decimation import build_pyramid, get_pyramid_size, get_pyramid_levels, get_pyramid_bounds
+from viewer.normalization import get_block_rows, normalize_block
+
+
+class TraceCache:
+    # Least recently used cache with a fixed number of traces (and optionally a max. size in bytes).
+    # Thread safe, traces of other ROIs are prefetched in a background thread.
+    def __init__(self, max_size=64, max_bytes=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.traces = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            trace = self.traces.get(key)
+            if trace is not None:
+                self.traces.move_to_end(key)
+            return trace
+
+    def put(self, key, trace):
+        with self.lock:
+            if key in self.traces:
+                self.n_bytes -= self.traces[key].nbytes
+            self.traces[key] = trace
+            self.traces.move_to_end(key)
+            self.n_bytes += trace.nbytes
+            # The newest trace is always kept
+            while len(self.traces) > 1 and (len(self.traces) > self.max_size or self._too_large()):
+                self.n_bytes -= self.traces.popitem(last=False)[1].nbytes
+
+    def _too_large(self):
+        return self.max_bytes is not None and self.n_bytes > self.max_bytes
+
+    def remove_roi(self, roi_id):
+        with self.lock:
+            for key in [key for key in self.traces if key[0] == roi_id]:
+                self.n_bytes -= self.traces.pop(key).nbytes
+
+    def clear(self):
+        with self.lock:
+            self.traces.clear()
+            self.n_bytes = 0
+
+
+class TraceStore:
+    # Contiguous (ROI x time) storage: one 2-D matrix per normalization mode and a ROI-name -> row index.
+    # Per-ROI traces are handed out as row views, so no data is copied when plotting a single ROI and whole
+    # population operations (min/max, stacking for the multi plot, ...) are single numpy calls on the matrix.
+    # Modes without a matrix (df, z, min_max unless they were precomputed) are derived per ROI from the raw traces
+    # when they are requested and kept in a LRU cache (key: roi, mode, fbs percentile, fbs window).
+    # Out-of-core mode (spill_dir): all matrices are memory mapped files in spill_dir, the OS pages them in and out,
+    # and the cache holds at most memory_limit bytes of traces.
+    # Min/max LOD pyramids (see decimation.py) are kept as (ROI x bins x 2) matrices for modes with a matrix (built in
+    # the background or read from a session file), pyramids of derived traces are built per ROI and cached.
+    # Summaries (pyramids and the min/max of all traces of a mode) are dropped whenever the traces of a mode change.
+    norm_modes = ('raw', 'df', 'z', 'min_max')
+    # Traces that are only derived (never saved): the baseline (F0) used for df
+    derived_modes = ('baseline',)
+
+    def __init__(self, roi_list, n_samples=None, dtype=np.float64, cache_size=64, memory_limit=None, spill_dir=None):
+        self.roi_list = list(roi_list)
+        self.roi_index = {roi: i for i, roi in enumerate(self.roi_list)}
+        self.n_samples = n_samples
+        self.dtype = dtype
+        self.matrices = dict()
+        # F baseline (fbs) of each ROI (NaN: not computed yet)
+        self.fbs = np.full(len(self.roi_list), np.nan)
+        self.spill_dir = spill_dir
+        self.memory_limit = memory_limit
+        # Lazy stores keep the raw matrix on disk (e.g. np.memmap), their rows are cached too
+        self.lazy = spill_dir is not None
+        # derive(roi_id, mode) -> trace, set by the DataHandler
+        self.derive = None
+        # The derived traces depend on the fbs percentile and the running baseline window (part of the cache key)
+        self.fbs_percentile = None
+        self.fbs_window = 0
+        # raw = raw - neuropil_coeff * neuropil (if there is a 'neuropil' matrix, e.g. from Suite2p)
+        self.neuropil_coeff = 0
+        self.cache = TraceCache(max_size=cache_size, max_bytes=memory_limit)
+        self.pyramids = dict()
+        # Increased whenever traces change, pyramids built in the background for an older version are dropped
+        self.version = 0
+        # mode -> (min, max) of all traces
+        self.ranges = dict()
+
+    def get_roi_count(self):
+        return len(self.roi_list)
+
+    def get_row_index(self, roi_id):
+        return self.roi_index[roi_id]
+
+    def has_mode(self, mode):
+        # Is there a materialized matrix for this mode
+        return mode in self.matrices
+
+    def provides(self, mode):
+        # Can a trace of this mode be returned (materialized or derived on request)
+        if mode in self.matrices:
+            return True
+        derived = mode in self.norm_modes or mode in self.derived_modes
+        return self.derive is not None and derived and 'raw' in self.matrices
+
+    def get_modes(self):
+        return [mode for mode in self.norm_modes if self.provides(mode)]
+
+    def new_matrix(self, n_samples=None):
+        # Empty (ROI x time) matrix, a memory mapped file in out-of-core mode
+        shape = (self.get_roi_count(), self.n_samples if n_samples is None else n_samples)
+        if self.spill_dir is None:
+            return np.zeros(shape, dtype=self.dtype)
+        fd, file_dir = tempfile.mkstemp(suffix='.dat', dir=self.spill_dir)
+        os.close(fd)
+        return np.memmap(file_dir, dtype=self.dtype, mode='w+', shape=shape)
+
+    def allocate(self, mode, n_samples=None):
+        if n_samples is not None:
+            self.n_samples = n_samples
+        self.matrices[mode] = self.new_matrix()
+        self._drop_summaries(mode)
+        return self.matrices[mode]
+
+    def set_matrix(self, mode, matrix):
+        # The matrix is stored as it is (no copy if dtype and layout already match), in out-of-core mode
+        # in-memory matrices are moved to a file
+        if matrix.shape[0] != self.get_roi_count():
+            raise ValueError(f'Matrix has {matrix.shape[0]} rows but there are {self.get_roi_count()} ROIs')
+        if not (isinstance(matrix, np.memmap) and matrix.dtype == self.dtype):
+            matrix = np.ascontiguousarray(matrix, dtype=self.dtype)
+            if self.spill_dir is not None:
+                spilled = self.new_matrix(n_samples=matrix.shape[1])
+                spilled[:] = matrix
+                spilled.flush()
+                matrix = spilled
+        self.n_samples = matrix.shape[1]
+        self.matrices[mode] = matrix
+        self._drop_summaries(mode)
+        if mode == 'raw':
+            self.invalidate()
+
+    def attach_matrix(self, mode, matrix):
+        # Keep an on-disk matrix (np.memmap, ...) as it is, rows are only read when they are accessed
+        if matrix.shape[0] != self.get_roi_count():
+            raise ValueError(f'Matrix has {matrix.shape[0]} rows but there are {self.get_roi_count()} ROIs')
+        self.n_samples = matrix.shape[1]
+        self.matrices[mode] = matrix
+        self.lazy = True
+        self.invalidate()
+
+    def set_row(self, mode, roi_id, values):
+        if mode not in self.matrices:
+            if mode != 'raw':
+                # Derived modes only get a matrix when they are precomputed for all ROIs
+                raise KeyError(mode)
+            self.allocate(mode, n_samples=len(values))
+        self.matrices[mode][self.roi_index[roi_id]] = values
+        if mode == 'raw':
+            self.invalidate(roi_id)
+        else:
+            self._drop_summaries(mode)
+
+    def invalidate(self, roi_id=None):
+        # The raw traces changed: forget everything derived from them
+        self._drop_summaries()
+        if roi_id is None:
+            self.cache.clear()
+            self.fbs[:] = np.nan
+        else:
+            self.cache.remove_roi(roi_id)
+            self.fbs[self.roi_index[roi_id]] = np.nan
+
+    def set_fbs_percentile(self, fbs_percentile, fbs_window=0):
+        self.fbs_percentile = fbs_percentile
+        self.fbs_window = fbs_window
+        self.fbs[:] = np.nan
+        # Precomputed modes are not valid anymore
+        for mode in ['df', 'z']:
+            self.matrices.pop(mode, None)
+            self._drop_summaries(mode)
+
+    def _neuropil_corrected(self, mode):
+        return mode == 'raw' and self.neuropil_coeff != 0 and 'neuropil' in self.matrices
+
+    def _read_row(self, mode, roi_id):
+        if self._neuropil_corrected(mode):
+            idx = self.roi_index[roi_id]
+            raw, neuropil = np.asarray(self.matrices['raw'][idx]), np.asarray(self.matrices['neuropil'][idx])
+            return raw - self.neuropil_coeff * neuropil
+        if mode in self.matrices:
+            return self.matrices[mode][self.roi_index[roi_id]]
+        return self.derive(roi_id, mode)
+
+    def flush(self):
+        # Write changed pages of memory mapped matrices to disk (the OS can then drop them from memory)
+        for matrix in self.matrices.values():
+            if isinstance(matrix, np.memmap):
+                matrix.flush()
+
+    def close(self):
+        # Out-of-core mode: remove the files of this store
+        self.matrices.clear()
+        self.pyramids.clear()
+        self.cache.clear()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+    def read_rows(self, mode, start, stop):
+        # Rows start ... stop-1 of a matrix of this mode (as an array, on-disk matrices are read here, derived modes are
+        # computed per ROI)
+        if self._neuropil_corrected(mode):
+            neuropil = np.asarray(self.matrices['neuropil'][start:stop])
+            return np.asarray(self.matrices['raw'][start:stop]) - self.neuropil_coeff * neuropil
+        if mode not in self.matrices:
+            return np.array([self.row(mode, roi) for roi in self.roi_list[start:stop]])
+        return np.asarray(self.matrices[mode][start:stop])
+
+    def set_neuropil_coeff(self, coeff):
+        # All derived traces depend on the corrected raw traces
+        self.neuropil_coeff = coeff
+        for mode in ['df', 'z', 'min_max']:
+            self.matrices.pop(mode, None)
+        self.invalidate()
+
+    def row(self, mode, roi_id):
+        if not self.provides(mode):
+            raise KeyError(mode)
+        if mode in self.matrices and not self.lazy and not self._neuropil_corrected(mode):
+            # Zero-copy view into the matrix of this mode
+            return self.matrices[mode][self.roi_index[roi_id]]
+
+        # Read from disk or derived: compute once and keep it in the cache
+        key = (roi_id, mode, self.fbs_percentile, self.fbs_window)
+        trace = self.cache.get(key)
+        if trace is None:
+            trace = self._read_row(mode, roi_id)
+            self.cache.put(key, trace)
+        return trace
+
+    def row_slice(self, mode, roi_id, start, stop):
+        # Samples start ... stop-1 of one trace, on-disk matrices only read this part (unless the row is cached)
+        start, stop, _ = slice(start, stop).indices(self.n_samples)
+        if mode in self.matrices and not self._neuropil_corrected(mode):
+            trace = self.cache.get((roi_id, mode, self.fbs_percentile, self.fbs_window)) if self.lazy else None
+            if trace is None:
+                return np.asarray(self.matrices[mode][self.roi_index[roi_id], start:stop])
+            return trace[start:stop]
+        return self.row(mode, roi_id)[start:stop]
+
+    def filtered_row(self, mode, roi_id, window, filter_func):
+        # filter_func(trace) of this ROI, cached until the trace changes (same cache as the derived traces)
+        key = (roi_id, mode, self.fbs_percentile, self.fbs_window, 'filtered', window)
+        trace = self.cache.get(key)
+        if trace is None:
+            trace = filter_func(self.row(mode, roi_id))
+            self.cache.put(key, trace)
+        return trace
+
+    def _drop_summaries(self, mode=None):
+        self.version += 1
+        if mode is None:
+            self.pyramids.clear()
+            self.ranges.clear()
+        else:
+            self.pyramids.pop(mode, None)
+            self.ranges.pop(mode, None)
+
+    def has_pyramid(self, mode):
+        return mode in self.pyramids
+
+    def attach_pyramid(self, mode, pyramid):
+        # Pyramid matrix (ROI x bins x 2) of a mode, e.g. a dataset of a session file
+        if pyramid.shape[:2] != (self.get_roi_count(), get_pyramid_size(self.n_samples)):
+            raise ValueError(f'Pyramid of {mode} does not match the traces')
+        self.pyramids[mode] = pyramid
+
+    def build_pyramid_matrix(self, mode, is_cancelled=None):
+        # Pyramids of all ROIs of a mode, block by block (on-disk matrices are read once). Runs in a background thread:
+        # the result is dropped if the traces changed in the meantime. Returns False if it was cancelled.
+        version = self.version
+        n_rois = self.get_roi_count()
+        shape = (n_rois, get_pyramid_size(self.n_samples), 2)
+        if self.spill_dir is None:
+            pyramid = np.empty(shape, dtype=self.dtype)
+        else:
+            fd, file_dir = tempfile.mkstemp(suffix='.dat', dir=self.spill_dir)
+            os.close(fd)
+            pyramid = np.memmap(file_dir, dtype=self.dtype, mode='w+', shape=shape)
+        block_rows = get_block_rows(self.n_samples, n_rois)
+        for start in range(0, n_rois, block_rows):
+            if (is_cancelled is not None and is_cancelled()) or version != self.version:
+                return False
+            stop = min(start + block_rows, n_rois)
+            pyramid[start:stop] = build_pyramid(self.read_rows(mode, start, stop), dtype=self.dtype)
+        if version != self.version:
+            return False
+        if isinstance(pyramid, np.memmap):
+            pyramid.flush()
+        self.pyramids[mode] = pyramid
+        return True
+
+    def pyramid_reader(self, mode, roi_id):
+        # read_bins(start, stop) for the pyramid of one trace: stored pyramids are only read in parts, otherwise the
+        # pyramid is built from the trace once and cached
+        if mode in self.pyramids and not self._neuropil_corrected(mode):
+            pyramid = self.pyramids[mode]
+            idx = self.roi_index[roi_id]
+            return lambda start, stop: pyramid[idx, start:stop]
+        key = (roi_id, mode, self.fbs_percentile, self.fbs_window, 'pyramid')
+        pyramid = self.cache.get(key)
+        if pyramid is None:
+            pyramid = build_pyramid(self.row(mode, roi_id), dtype=self.dtype)
+            self.cache.put(key, pyramid)
+        return lambda start, stop: pyramid[start:stop]
+
+    def matrix(self, mode):
+        if mode in self.matrices and not self._neuropil_corrected(mode):
+            return self.matrices[mode]
+        if self.provides(mode):
+            return DerivedRows(self, mode)
+        raise KeyError(mode)
+
+    def get_fbs(self, roi_id):
+        idx = self.roi_index[roi_id]
+        if np.isnan(self.fbs[idx]) and self.derive is not None:
+            self.fbs[idx] = self.derive(roi_id, 'fbs')
+        return self.fbs[idx]
+
+    def set_fbs(self, roi_id, value):
+        self.fbs[self.roi_index[roi_id]] = value
+
+    def to_array(self, mode):
+        # The whole matrix of this mode in memory (derived modes are computed for every ROI)
+        matrix = self.matrix(mode)
+        if isinstance(matrix, DerivedRows):
+            return np.array([matrix[k] for k in range(len(matrix))])
+        return np.asarray(matrix)
+
+    def get_range(self, mode):
+        # Min and max of all traces of a mode, computed once: from the coarsest pyramid level of each ROI if there are
+        # pyramids (reads n_rois x pyramid_min_bins values), otherwise from all traces (see compute_range)
+        value = self.ranges.get(mode)
+        if value is None:
+            if mode in self.pyramids:
+                _, offset, n_bins = get_pyramid_levels(self.n_samples)[-1]
+                top_level = np.asarray(self.pyramids[mode][:, offset:offset + n_bins])
+                value = float(np.nanmin(top_level[..., 0])), float(np.nanmax(top_level[..., 1]))
+                self.ranges[mode] = value
+            else:
+                value = self.compute_range(mode)
+        return value
+
+    def range_is_cheap(self, mode):
+        # The range of a mode is known or only needs the pyramids or an in-memory matrix (no reading from disk, no
+        # deriving of every ROI)
+        if mode in self.ranges or mode in self.pyramids:
+            return True
+        return mode in self.matrices and not self.lazy and not self._neuropil_corrected(mode)
+
+    def compute_range(self, mode, is_cancelled=None):
+        # Min and max of all traces of a mode, block by block: on-disk matrices are read once, derived modes are
+        # normalized per block from the raw traces (like normalize_matrix), the trace cache is not used. Runs in a
+        # background thread for on-disk and derived traces: the result is dropped if the traces changed in the
+        # meantime. Returns None if it was cancelled.
+        version = self.version
+        n_rois = self.get_roi_count()
+        derived = mode not in self.matrices
+        # Index of the mode in the result of normalize_block
+        mode_index = {'df': 1, 'z': 2, 'min_max': 3}
+        y_min, y_max = np.inf, -np.inf
+        block_rows = get_block_rows(self.n_samples, n_rois)
+        for start in range(0, n_rois, block_rows):
+            if (is_cancelled is not None and is_cancelled()) or version != self.version:
+                return None
+            stop = min(start + block_rows, n_rois)
+            if derived:
+                block = normalize_block(self.read_rows('raw', start, stop), self.fbs_percentile,
+                                        self.fbs_window)[mode_index[mode]].astype(self.dtype, copy=False)
+            else:
+                block = self.read_rows(mode, start, stop)
+            y_min = min(y_min, float(np.nanmin(block)))
+            y_max = max(y_max, float(np.nanmax(block)))
+        if version != self.version:
+            return None
+        self.ranges[mode] = (y_min, y_max)
+        return self.ranges[mode]
+
+    def get_roi_range(self, mode, roi_id):
+        # Min and max of one trace from its pyramid (the pyramid of a derived trace is built once and cached)
+        y_min, y_max = get_pyramid_bounds(self.n_samples, self.pyramid_reader(mode, roi_id))
+        return float(y_min), float(y_max)
+
+
+class DerivedRows:
+    # Matrix-like access (shape, [row]) to a mode that is only derived per ROI
+    def __init__(self, store, mode):
+        self.store = store
+        self.mode = mode
+        self.shape = (store.get_roi_count(), store.n_samples)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, row_index):
+        return self.store.row(self.mode, self.store.roi_list[row_index])
+
+
+class RoiTraces(MutableMapping):
+    # Dict-like view on the traces of one ROI (this is what data[roi]['data_traces'] points to).
+    # Normalization modes and 'fbs' live in the TraceStore, everything else (e.g. 'filtered') is kept per ROI.
+    def __init__(self, store, roi_id):
+        self.store = store
+        self.roi_id = roi_id
+        self.extra = dict()
+
+    def __getitem__(self, key):
+        if key == 'fbs':
+            return self.store.get_fbs(self.roi_id)
+        if self.store.provides(key):
+            return self.store.row(key, self.roi_id)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key == 'fbs':
+            self.store.set_fbs(self.roi_id, value)
+        elif key in self.store.norm_modes:
+            self.store.set_row(key, self.roi_id, value)
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        # Rows of the store can not be removed for a single ROI
+        del self.extra[key]
+
+    def __iter__(self):
+        for mode in self.store.get_modes():
+            yield mode
+        if self.store.get_modes():
+            yield 'fbs'
+        for key in self.extra:
+            yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def to_dict(self):
+        # Plain dict (used for saving to file, pickle stores only the data of each row view)
+        return {key: self[key] for key in self}